@@ -0,0 +1,284 @@
+#! python3
+# -*- encoding: utf-8 -*-
+
+# Synthetic EDI corpus generator and throughput benchmark for
+#   edi_inbound_rename.py.
+# The corpus covers every sender ID in partners.json, so a benchmark run
+#   exercises the same routes as production.
+#
+# Generate a corpus:
+#   python edi_benchmark.py generate DIR --count 10000
+# Benchmark 1k, 10k and 100k file staging directories:
+#   python edi_benchmark.py run --counts 1000,10000,100000
+
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+import edi_inbound_rename as edi
+
+
+X12_TYPES = ("850", "860", "830", "862", "856")
+EDIFACT_TYPES = ("DELFOR", "DESADV")
+UNKNOWN_SENDER = "UNKNOWN0001"
+
+# Detail lines per file follow a lognormal distribution
+LINES_MEDIAN = 5
+LINES_SIGMA = 1.0
+LINES_MAX = 5000
+
+BASE_TIME = datetime(2020, 10, 6, 10, 15, 20)
+
+
+def load_senders(path=edi.PARTNERS_FILE):
+    # Every partner entry, enabled or not, from the partners file
+    with open(path, encoding="utf-8") as partners_file:
+        return json.load(partners_file)["partners"]
+
+
+def ship_from_segment_x12(partner, rng):
+    ship_from = partner.get("ship_from")
+    if not ship_from:
+        return "N1*SF*THOMSON PLASTICS*92*140472"
+    value = rng.choice(sorted(ship_from["codes"]))
+    if ship_from["element"] == "name":
+        return "N1*SF*" + value
+    return "N1*SF*" + partner["name"].upper() + "*92*" + value
+
+
+def make_x12(partner, doc_type, lines, rng, control, stamp):
+    date = stamp.strftime("%Y%m%d")
+    segments = [
+        "GS*%s*%s*THOMSON*%s*%s*%d*X*004010" % (
+            {"850": "PO", "860": "PC", "830": "PS", "862": "SS", "856": "SH"}[doc_type],
+            partner["sender"], date, stamp.strftime("%H%M"), control),
+        "ST*%s*0001" % doc_type,
+    ]
+    if doc_type == "850":
+        segments.append("BEG*00*SA*PO%d**%s" % (control, date))
+    elif doc_type == "860":
+        segments.append("BCH*04*SA*PO%d***%s" % (control, date))
+    elif doc_type == "856":
+        segments.append("BSN*00*SH%d*%s*%s" % (control, date, stamp.strftime("%H%M")))
+        segments.append("HL*1**S")
+    else:
+        segments.append("BFR*05**%d*DL*A*%s*%s*%s" % (control, date, date, date))
+    segments.append(ship_from_segment_x12(partner, rng))
+    for line in range(1, lines + 1):
+        part = "PART%05d" % rng.randrange(100000)
+        qty = rng.randrange(1, 5000)
+        if doc_type == "850":
+            segments.append("PO1*%d*%d*EA*1.25**BP*%s" % (line, qty, part))
+            segments.append("PID*F****WIDGET %s" % part)
+        elif doc_type == "860":
+            segments.append("POC*%d*CA*%d*0*EA*1.25**BP*%s" % (line, qty, part))
+        elif doc_type == "856":
+            segments.append("HL*%d*1*I" % (line + 1))
+            segments.append("LIN**BP*%s" % part)
+            segments.append("SN1**%d*EA" % qty)
+        else:
+            segments.append("LIN**BP*%s" % part)
+            segments.append("UIT*EA")
+            for week in range(4):
+                day = (stamp + timedelta(weeks=week)).strftime("%Y%m%d")
+                segments.append("FST*%d*C*W*%s" % (qty + week, day))
+    if doc_type != "856":
+        segments.append("CTT*%d" % lines)
+    segments.append("SE*%d*0001" % (len(segments)))
+    segments.append("GE*1*%d" % control)
+    segments.append("IEA*1*%09d" % control)
+    isa = "ISA*00*          *00*          *ZZ*%-15s*ZZ*THOMSON        *%s*%s*U*00401*%09d*0*P*>" % (
+        partner["sender"], stamp.strftime("%y%m%d"), stamp.strftime("%H%M"), control)
+    return isa + "~\n" + "".join(segment + "~\n" for segment in segments)
+
+
+def make_edifact(partner, doc_type, lines, rng, control, stamp):
+    date = stamp.strftime("%Y%m%d")
+    segments = [
+        "UNH+1+%s:D:96A:UN" % doc_type,
+        "BGM+%s+%d+9" % ("241" if doc_type == "DELFOR" else "351", control),
+        "DTM+137:%s:102" % date,
+        "NAD+SF+%s::92" % rng.choice(("02054850", "02054851", "02054852")),
+    ]
+    for line in range(1, lines + 1):
+        part = "PART%05d" % rng.randrange(100000)
+        qty = rng.randrange(1, 5000)
+        segments.append("LIN+%d++%s:IN" % (line, part))
+        if doc_type == "DELFOR":
+            for week in range(4):
+                day = (stamp + timedelta(weeks=week)).strftime("%Y%m%d")
+                segments.append("QTY+1:%d:PCE" % (qty + week))
+                segments.append("DTM+2:%s:102" % day)
+        else:
+            segments.append("QTY+12:%d:PCE" % qty)
+    segments.append("UNT+%d+1" % (len(segments) + 1))
+    return ("UNA:+.? 'UNB+UNOA:3+%s:ZZ+THOMSON:ZZ+%s:%s+%d'" % (
+        partner["sender"], stamp.strftime("%y%m%d"), stamp.strftime("%H%M"), control)
+        + "".join(segment + "'" for segment in segments)
+        + "UNZ+1+%d'" % control)
+
+
+def generate_corpus(directory, count, seed=0, unknown=0.02, lines_median=LINES_MEDIAN,
+                    lines_sigma=LINES_SIGMA, lines_max=LINES_MAX):
+    # Writes count files to directory. The same arguments always give the
+    # same files. Returns the total number of bytes written.
+    rng = random.Random(seed)
+    partners = load_senders()
+    unknown_partner = {"name": "Unknown", "syntax": edi.X12, "sender": UNKNOWN_SENDER,
+                       "prefix": "1027"}
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for idx in range(count):
+        partner = unknown_partner if rng.random() < unknown else rng.choice(partners)
+        stamp = BASE_TIME + timedelta(seconds=idx)
+        lines = min(lines_max, max(1, int(rng.lognormvariate(0, lines_sigma) * lines_median)))
+        control = idx + 1
+        if partner["syntax"] == edi.EDIFACT:
+            data = make_edifact(partner, rng.choice(EDIFACT_TYPES), lines, rng, control, stamp)
+        else:
+            data = make_x12(partner, rng.choice(X12_TYPES), lines, rng, control, stamp)
+        if partner["prefix"] == "TP":
+            filename = "TP-%s-%06d.edi" % (stamp.strftime("%Y%m%d"), idx)
+        else:
+            # Unique 8 digit hex id, like ECGrid's
+            filename = "1027-%s-%08x.edi" % (stamp.strftime("%Y%m%d%H%M%S"),
+                                              (idx * 2654435761) & 0xFFFFFFFF)
+        with open(os.path.join(directory, filename), "w", newline="") as edifile:
+            edifile.write(data)
+        total += len(data)
+    return total
+
+
+def latency_percentile(histogram, pct):
+    # Upper bound of the READ_BUCKETS bucket holding the pct percentile of a
+    # RunMetrics latency histogram, or the largest bound when it is above
+    # them all
+    wanted = histogram["count"] * pct / 100
+    bounds = sorted((float(bound), count) for bound, count in histogram["buckets"].items())
+    for bound, count in bounds:
+        if count >= wanted:
+            return bound
+    return bounds[-1][0] if bounds else 0.0
+
+
+def run_benchmark(root, count, seed=0, workers=0, pool="thread", chunk_size=edi.STAGING_CHUNK,
+                  split=False, **corpus_args):
+    # Runs process_staging_dir over a fresh corpus of count files and returns
+    # the timings, with the time of each stage taken from its RunMetrics.
+    staging = os.path.join(root, "STAGING")
+    in_dir = os.path.join(root, "IN")
+    metrics_dir = os.path.join(root, "metrics")
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(in_dir)
+    corpus_bytes = generate_corpus(staging, count, seed, **corpus_args)
+    edi.staging_dir, edi.in_dir = staging, in_dir
+    options = edi.Options(workers=workers, pool=pool, metrics_dir=metrics_dir,
+                          chunk_size=chunk_size, split=split)
+
+    result = {"files": count, "corpus_bytes": corpus_bytes, "workers": workers, "pool": pool,
+              "chunk_size": chunk_size, "split": split}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        edi.process_staging_dir(options)
+        total = time.perf_counter() - start
+    with open(os.path.join(metrics_dir, edi.METRICS_NAME + ".json"), encoding="utf-8") as metrics_file:
+        metrics = json.load(metrics_file)
+
+    stages = metrics["stage_seconds"]
+    latency = metrics["read_latency_seconds"]
+    result.update({
+        "seconds": total,
+        "files_per_sec": count / total if total else 0.0,
+        "list_seconds": stages["list"],
+        # Summed over the workers, so more than the wall time with a pool
+        "read_seconds": stages["read"],
+        "route_seconds": stages["route"],
+        "rename_seconds": stages["rename"],
+        "matched": sum(metrics["files_matched"].values()),
+        "bytes_read_per_file": metrics["bytes_read"] / max(1, metrics["files_scanned"]),
+    })
+    if latency["count"]:
+        result.update({
+            "read_p50_ms": latency_percentile(latency, 50) * 1000,
+            "read_p95_ms": latency_percentile(latency, 95) * 1000,
+            "read_p99_ms": latency_percentile(latency, 99) * 1000,
+        })
+    shutil.rmtree(root, ignore_errors=True)
+    return result
+
+
+def default_root():
+    # A tmpfs directory where there is one, so the disk isn't measured
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "edi_benchmark")
+
+
+def print_result(result):
+    line = "%(files)8d files  %(files_per_sec)10.1f files/s  list %(list_seconds).3fs  " \
+           "read %(read_seconds).3fs  route %(route_seconds).3fs  rename %(rename_seconds).3fs  " \
+           "%(bytes_read_per_file).0f bytes read/file" % result
+    if "read_p50_ms" in result:
+        # Bucket bounds, so "at most" these times
+        line += "  p50 <=%(read_p50_ms).1fms p95 <=%(read_p95_ms).1fms " \
+                "p99 <=%(read_p99_ms).1fms" % result
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EDI corpus generator and staging benchmark")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def corpus_options(command):
+        command.add_argument("--seed", type=int, default=0)
+        command.add_argument("--unknown", type=float, default=0.02,
+                             help="fraction of files from an unknown sender")
+        command.add_argument("--lines-median", type=int, default=LINES_MEDIAN,
+                             help="median detail lines per file")
+        command.add_argument("--lines-sigma", type=float, default=LINES_SIGMA,
+                             help="spread of the lognormal line count")
+        command.add_argument("--lines-max", type=int, default=LINES_MAX)
+
+    generate = sub.add_parser("generate", help="write a corpus to a directory")
+    generate.add_argument("directory")
+    generate.add_argument("--count", type=int, default=1000)
+    corpus_options(generate)
+
+    run = sub.add_parser("run", help="time staging passes over generated corpora")
+    run.add_argument("--counts", default="1000,10000,100000",
+                     help="comma separated staging directory sizes")
+    run.add_argument("--dir", default=default_root(), help="scratch directory, tmpfs by default")
+    run.add_argument("--workers", type=int, default=0)
+    run.add_argument("--pool", choices=("thread", "process"), default="thread")
+    run.add_argument("--chunk-size", type=int, default=edi.STAGING_CHUNK,
+                     help="files read from STAGING per batch, 0 for all")
+    run.add_argument("--split", action="store_true", help="split multi transaction set files")
+    run.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    corpus_options(run)
+
+    args = parser.parse_args(argv)
+    corpus_args = {"unknown": args.unknown, "lines_median": args.lines_median,
+                   "lines_sigma": args.lines_sigma, "lines_max": args.lines_max}
+    if args.command == "generate":
+        total = generate_corpus(args.directory, args.count, args.seed, **corpus_args)
+        print("Wrote %d files, %d bytes, to %s" % (args.count, total, args.directory))
+        return
+
+    results = []
+    for count in [int(count) for count in args.counts.split(",")]:
+        result = run_benchmark(args.dir, count, args.seed, args.workers, args.pool,
+                               args.chunk_size, args.split, **corpus_args)
+        print_result(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+#! python3
+# -*- encoding: utf-8 -*-
+
+# X12 and EDIFACT document model for jobs that read the renamed files.
+# Built on the tokenizer in edi_inbound_rename.py, so delimiters, UNA and
+#   release characters are handled the same way as when routing.
+#
+# Segments are kept as the raw text from the file. Segment and Element
+#   views are made when they are asked for, and a segment is only split into
+#   elements when one of its elements is read, so pulling a few fields from a
+#   large 830 doesn't build objects for every segment.
+#
+# Read a whole file:
+#   for interchange in edi_document.read_document(path):
+#       for group in interchange.groups:
+#           for ts in group.transaction_sets:
+#               print(ts.doc_type, ts.find("BFR").value(2))
+# Stream one transaction set at a time:
+#   for ts in edi_document.iter_transaction_sets(path):
+#       ...
+
+import edi_inbound_rename as edi
+
+
+READ_SIZE = 64 * 1024  # Bytes read at a time
+
+# Envelope segments for each syntax: interchange, group and transaction set
+# header and trailer tags
+ENVELOPE_TAGS = {
+    edi.X12: (("ISA", "IEA"), ("GS", "GE"), ("ST", "SE")),
+    edi.EDIFACT: (("UNB", "UNZ"), ("UNG", "UNE"), ("UNH", "UNT")),
+}
+
+
+class Delimiters:
+    # The separators of one interchange
+    __slots__ = ("syntax", "element", "component", "segment", "release")
+
+    def __init__(self, syntax, element, component, segment, release=None):
+        self.syntax = syntax
+        self.element = element
+        self.component = component
+        self.segment = segment
+        self.release = release
+
+
+class Element:
+    # One element of a segment. X12 elements are kept as text and split
+    # into components on demand; EDIFACT elements arrive as components.
+    __slots__ = ("_data", "delimiters")
+
+    def __init__(self, data, delimiters):
+        self._data = data
+        self.delimiters = delimiters
+
+    @property
+    def components(self):
+        if isinstance(self._data, list):
+            return self._data
+        return self._data.split(self.delimiters.component)
+
+    @property
+    def value(self):
+        # The element as text, with any release characters removed
+        if isinstance(self._data, list):
+            return self.delimiters.component.join(self._data)
+        return self._data
+
+    def __getitem__(self, idx):
+        return self.components[idx]
+
+    def __len__(self):
+        return len(self.components)
+
+    def __str__(self):
+        return self.value
+
+    def __repr__(self):
+        return "Element(%r)" % self.value
+
+
+class Segment:
+    # One segment, split into elements the first time one is read.
+    # Element 0 is the tag, so segment[1] is ST01 or the first UNH element.
+    __slots__ = ("text", "delimiters", "_elements")
+
+    def __init__(self, text, delimiters):
+        self.text = text
+        self.delimiters = delimiters
+        self._elements = None
+
+    @property
+    def tag(self):
+        return segment_tag(self.text, self.delimiters)
+
+    @property
+    def elements(self):
+        if self._elements is None:
+            d = self.delimiters
+            if d.syntax == edi.X12:
+                self._elements = self.text.split(d.element)
+            else:
+                self._elements = edi.split_segment_edifact(self.text, d.element, d.component,
+                                                            d.release)
+        return self._elements
+
+    def value(self, idx, component=None, default=None):
+        # The text of element idx, or of one of its components, without
+        # making an Element. default when the segment is shorter.
+        elements = self.elements
+        if idx >= len(elements):
+            return default
+        data = elements[idx]
+        if component is None and not isinstance(data, list):
+            return data
+        components = data if isinstance(data, list) else data.split(self.delimiters.component)
+        if component is None:
+            return self.delimiters.component.join(components)
+        return components[component] if component < len(components) else default
+
+    def __getitem__(self, idx):
+        return Element(self.elements[idx], self.delimiters)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def __iter__(self):
+        for data in self.elements:
+            yield Element(data, self.delimiters)
+
+    def __repr__(self):
+        return "Segment(%r)" % self.text
+
+
+def segment_tag(text, delimiters):
+    # The tag of a raw segment, without splitting the rest of it
+    end = text.find(delimiters.element)
+    return text if end == -1 else text[:end]
+
+
+class SegmentList:
+    # Raw segment texts, viewed as Segments one at a time
+    __slots__ = ("texts", "delimiters")
+
+    def __init__(self, texts, delimiters):
+        self.texts = texts
+        self.delimiters = delimiters
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, idx):
+        return Segment(self.texts[idx], self.delimiters)
+
+    def __iter__(self):
+        for text in self.texts:
+            yield Segment(text, self.delimiters)
+
+    def tags(self):
+        return [segment_tag(text, self.delimiters) for text in self.texts]
+
+    def find(self, tag):
+        # The first segment with tag, or None
+        return next(self.find_all(tag), None)
+
+    def find_all(self, tag):
+        # Segments with tag, found by their text before anything is split
+        prefix = tag + self.delimiters.element
+        for text in self.texts:
+            if text.startswith(prefix) or text == tag:
+                yield Segment(text, self.delimiters)
+
+
+class TransactionSet(SegmentList):
+    # ST to SE, or UNH to UNT, with the group it came in
+    __slots__ = ("group",)
+
+    def __init__(self, texts, delimiters, group=None):
+        super().__init__(texts, delimiters)
+        self.group = group
+
+    @property
+    def header(self):
+        return self[0]
+
+    @property
+    def trailer(self):
+        return self[-1]
+
+    @property
+    def doc_type(self):
+        if self.delimiters.syntax == edi.X12:
+            return self.header.value(1)
+        return self.header.value(2, 0)
+
+    @property
+    def control_number(self):
+        if self.delimiters.syntax == edi.X12:
+            return self.header.value(2)
+        return self.header.value(1, 0)
+
+    def __repr__(self):
+        return "TransactionSet(%s %s, %d segments)" % (self.doc_type, self.control_number, len(self))
+
+
+class Group:
+    # GS to GE, or UNG to UNE. An EDIFACT interchange without UNG gets
+    # one group with no header or trailer.
+    __slots__ = ("header", "trailer", "transaction_sets", "interchange")
+
+    def __init__(self, header, interchange=None):
+        self.header = header
+        self.trailer = None
+        self.transaction_sets = []
+        self.interchange = interchange
+
+    @property
+    def group_type(self):
+        if self.header is None:
+            return None
+        return self.header.value(1, 0)
+
+    @property
+    def control_number(self):
+        if self.header is None:
+            return None
+        if self.header.delimiters.syntax == edi.X12:
+            return self.header.value(6)
+        return self.header.value(5, 0)
+
+    def __repr__(self):
+        return "Group(%s %s, %d sets)" % (self.group_type, self.control_number,
+                                          len(self.transaction_sets))
+
+
+class Interchange:
+    # ISA to IEA, or UNB to UNZ
+    __slots__ = ("header", "trailer", "groups", "delimiters")
+
+    def __init__(self, header, delimiters):
+        self.header = header
+        self.trailer = None
+        self.groups = []
+        self.delimiters = delimiters
+
+    @property
+    def sender(self):
+        if self.delimiters.syntax == edi.X12:
+            return self.header.value(6).rstrip()
+        return self.header.value(2, 0)
+
+    @property
+    def receiver(self):
+        if self.delimiters.syntax == edi.X12:
+            return self.header.value(8).rstrip()
+        return self.header.value(3, 0)
+
+    @property
+    def control_number(self):
+        if self.delimiters.syntax == edi.X12:
+            return self.header.value(13)
+        return self.header.value(5, 0)
+
+    def transaction_sets(self):
+        for group in self.groups:
+            yield from group.transaction_sets
+
+    def __repr__(self):
+        return "Interchange(%s %s %s, %d groups)" % (self.delimiters.syntax, self.sender,
+                                                     self.control_number, len(self.groups))
+
+
+def interchange_encoding(syntax, sender, charset=None):
+    # The encoding of an interchange: the UNB syntax identifier's character
+    # set, else the partner's encoding, else edi.DEFAULT_ENCODING
+    if charset:
+        return charset
+    partner = edi.ROUTES.get((syntax, sender))
+    return (partner and partner.encoding) or edi.DEFAULT_ENCODING
+
+
+def iter_raw_segments(edifile, size=READ_SIZE):
+    # Yields the Delimiters and the text of each segment of a file opened
+    # in binary. Segments are split as bytes and decoded with the encoding
+    # of the interchange they are in, as edi.read_header does.
+    # Raises ValueError when the file isn't X12 or EDIFACT.
+    data = edifile.read(3)
+    if data == b"ISA":
+        isa = data + edifile.read(edi.ISA_SIZE - len(data))
+        element, component, term = edi.get_delimiters_x12(isa)
+        delimiters = Delimiters(edi.X12, *[
+            delimiter.decode(edi.DEFAULT_ENCODING) for delimiter in (element, component, term)])
+        encoding = edi.DEFAULT_ENCODING
+        for segment in edi.read_segments(edifile, isa, term, size):
+            if segment.startswith(b"ISA" + element):
+                sender = segment.split(element)[6].decode(edi.DEFAULT_ENCODING).rstrip()
+                encoding = interchange_encoding(edi.X12, sender)
+            yield delimiters, segment.decode(encoding, "replace")
+    elif data in (b"UNA", b"UNB"):
+        data += edifile.read(edi.UNA_SIZE - len(data))
+        component, element, release, term = edi.get_delimiters_edifact(data)
+        delimiters = Delimiters(edi.EDIFACT, *[
+            delimiter and delimiter.decode(edi.DEFAULT_ENCODING)
+            for delimiter in (element, component, term, release)])
+        if data.startswith(b"UNA"):
+            data = data[edi.UNA_SIZE:]
+        encoding = edi.DEFAULT_ENCODING
+        for segment in edi.read_segments_edifact(edifile, data, term, release, size):
+            if segment.startswith(b"UNB" + element):
+                # The UNB itself is in the ASCII service characters
+                unb = edi.split_segment_edifact(segment.decode(edi.DEFAULT_ENCODING),
+                                                delimiters.element, delimiters.component,
+                                                delimiters.release)
+                charset = edi.EDIFACT_CHARSETS.get(unb[1][0]) if len(unb) > 1 else None
+                encoding = interchange_encoding(edi.EDIFACT, unb[2][0] if len(unb) > 2 else None,
+                                                charset)
+            yield delimiters, segment.decode(encoding, "replace")
+    else:
+        raise ValueError("Not an X12 or EDIFACT file")
+
+
+def iter_interchange_parts(edifile, size=READ_SIZE):
+    # Yields each TransactionSet as soon as its trailer is read, with its
+    # Group and Interchange filled in as far as the file has got. Only the
+    # segments of the current transaction set are held.
+    interchange = group = texts = None
+    for delimiters, text in iter_raw_segments(edifile, size):
+        tag = segment_tag(text, delimiters)
+        (ic_head, ic_tail), (gr_head, gr_tail), (ts_head, ts_tail) = ENVELOPE_TAGS[delimiters.syntax]
+        if texts is not None:
+            texts.append(text)
+            if tag == ts_tail:
+                if group is None:
+                    group = Group(None, interchange)
+                    interchange.groups.append(group)
+                ts = TransactionSet(texts, delimiters, group)
+                texts = None
+                yield ts
+        elif tag == ts_head:
+            texts = [text]
+        elif tag == ic_head:
+            interchange = Interchange(Segment(text, delimiters), delimiters)
+            group = None
+        elif tag == gr_head:
+            group = Group(Segment(text, delimiters), interchange)
+            interchange.groups.append(group)
+        elif tag == gr_tail and group is not None:
+            group.trailer = Segment(text, delimiters)
+            group = None
+        elif tag == ic_tail and interchange is not None:
+            interchange.trailer = Segment(text, delimiters)
+    if texts:
+        raise ValueError("File ends inside a transaction set")
+
+
+def iter_transaction_sets(path, size=READ_SIZE):
+    # The transaction sets of a file, one at a time. ts.group and
+    # ts.group.interchange give the envelopes; later sets are not linked
+    # from them, so each set can be released once it has been handled.
+    with open(path, "rb") as edifile:
+        for ts in iter_interchange_parts(edifile, size):
+            ts.group.transaction_sets = [ts]
+            yield ts
+
+
+def read_document(path, size=READ_SIZE):
+    # Every interchange in a file, with its groups and transaction sets
+    interchanges = []
+    with open(path, "rb") as edifile:
+        for ts in iter_interchange_parts(edifile, size):
+            ts.group.transaction_sets.append(ts)
+            interchange = ts.group.interchange
+            if not interchanges or interchanges[-1] is not interchange:
+                interchanges.append(interchange)
+    return interchanges
@@ -0,0 +1,215 @@
+#! python3
+# -*- encoding: utf-8 -*-
+
+# Forecast and schedule line extraction for the planners.
+# Pulls the LIN/SDP/FST rows of X12 830 and 862 files, and the LIN/QTY/DTM
+#   rows of EDIFACT DELFOR and DELJIT files, into column batches keyed by the
+#   partner tag and ship from code in the new file name.
+# edi_inbound_rename.py runs this after each rename batch with --extract DIR.
+#
+# Extract the files already in IN:
+#   python edi_extract.py DIR FILE [FILE ...]
+# Total the quantities of a month of batches:
+#   columns = edi_extract.read_batches(DIR)
+#   array = edi_extract.to_array(columns)  # Needs NumPy
+
+import os
+import csv
+import sys
+import time
+import argparse
+
+import edi_document
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EXTRACT_TYPES = ("830", "862", "DELFOR", "DELJIT")
+
+# Column name and NumPy type of each field of a row
+COLUMNS = (
+    ("file", "U64"),
+    ("tag", "U16"),
+    ("ship_from", "U8"),
+    ("doc_type", "U8"),
+    ("control_number", "U14"),
+    ("line", "i4"),            # LIN number within the transaction set
+    ("item", "U48"),           # Buyer's part number
+    ("quantity", "f8"),
+    ("qualifier", "U3"),       # FST02, or the QTY qualifier
+    ("timing", "U3"),          # FST03 forecast timing, X12 only
+    ("date", "U12"),           # CCYYMMDD
+    ("end_date", "U12"),
+    ("pattern", "U6"),         # SDP ship pattern, or SCC for EDIFACT
+)
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+BATCH_PREFIX = "lines-"
+
+
+def name_key(new_filename):
+    # (tag, ship from, type) from TAG[-SF]-TYPE-DATE-IDX.edi
+    parts = os.path.splitext(os.path.basename(new_filename))[0].split("-")
+    ship_from = parts[1] if len(parts) == 5 else ""
+    return parts[0], ship_from, parts[-3] if len(parts) >= 4 else ""
+
+
+def wants(new_filename):
+    # True for the document types this stage reads, judged by the name
+    return name_key(new_filename)[2] in EXTRACT_TYPES
+
+
+def x12_date(value):
+    # Six digit dates are YYMMDD
+    return "20" + value if len(value) == 6 else value
+
+
+def rows_x12(ts, key):
+    # One row per FST, with the LIN and SDP in force
+    line = 0
+    item = pattern = ""
+    for segment in ts:
+        tag = segment.tag
+        if tag == "LIN":
+            line += 1
+            # LIN02/03 is the first qualifier/ID pair, usually BP
+            item = segment.value(3, default="")
+            pattern = ""
+        elif tag == "SDP":
+            pattern = segment.value(1, default="") + segment.value(2, default="")
+        elif tag == "FST":
+            yield key + (ts.control_number, line, item,
+                         float(segment.value(1, default="0") or 0),
+                         segment.value(2, default=""), segment.value(3, default=""),
+                         x12_date(segment.value(4, default="")),
+                         x12_date(segment.value(5, default="")), pattern)
+
+
+def rows_edifact(ts, key):
+    # One row per QTY, dated by the DTM segments that follow it
+    line = 0
+    item = pattern = ""
+    row = None
+    for segment in ts:
+        tag = segment.tag
+        if tag in ("LIN", "QTY", "SCC", "UNS", "UNT") and row is not None:
+            yield tuple(row)
+            row = None
+        if tag == "LIN":
+            line += 1
+            item = segment.value(3, 0, "")
+            pattern = ""
+        elif tag == "SCC":
+            pattern = segment.value(1, 0, "")
+        elif tag == "QTY" and line:
+            row = list(key + (ts.control_number, line, item,
+                              float(segment.value(1, 1, "0") or 0),
+                              segment.value(1, 0, ""), "", "", "", pattern))
+        elif tag == "DTM" and row is not None:
+            qualifier = segment.value(1, 0, "")
+            value = segment.value(1, 1, "")[:8]
+            if qualifier == "159":
+                # Period end
+                row[11] = value
+            elif not row[10]:
+                row[10] = value
+    if row is not None:
+        yield tuple(row)
+
+
+def extract_file(path, new_filename=None):
+    # The rows of every forecast or schedule transaction set in a file
+    tag, ship_from, _ = name_key(new_filename or path)
+    file_key = os.path.basename(new_filename or path)
+    rows = []
+    for ts in edi_document.iter_transaction_sets(path):
+        doc_type = ts.doc_type
+        if doc_type not in EXTRACT_TYPES:
+            continue
+        key = (file_key, tag, ship_from, doc_type)
+        if ts.delimiters.syntax == edi_document.edi.X12:
+            rows.extend(rows_x12(ts, key))
+        else:
+            rows.extend(rows_edifact(ts, key))
+    return rows
+
+
+def write_batch(directory, rows, fmt="csv"):
+    # Writes the rows as one batch file, through a temporary name.
+    # fmt "npy" writes a NumPy structured array. Returns the path.
+    os.makedirs(directory, exist_ok=True)
+    name = BATCH_PREFIX + time.strftime("%Y%m%d%H%M%S") + "-%d" % os.getpid()
+    path = os.path.join(directory, name + "." + fmt)
+    count = 1
+    while os.path.exists(path):
+        count += 1
+        path = os.path.join(directory, name + "-%d.%s" % (count, fmt))
+    if fmt == "npy":
+        # Made first, so a missing NumPy fails before anything is written
+        array = to_array(columns_from_rows(rows))
+        with open(path + ".tmp", "wb") as batch:
+            numpy.save(batch, array)
+    else:
+        with open(path + ".tmp", "w", newline="", encoding="utf-8") as batch:
+            writer = csv.writer(batch)
+            writer.writerow(COLUMN_NAMES)
+            writer.writerows(rows)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def columns_from_rows(rows):
+    columns = {name: [] for name in COLUMN_NAMES}
+    for row in rows:
+        for name, value in zip(COLUMN_NAMES, row):
+            columns[name].append(value)
+    return columns
+
+
+def read_batches(directory):
+    # The CSV batches in directory as one list per column
+    columns = {name: [] for name in COLUMN_NAMES}
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(BATCH_PREFIX) and name.endswith(".csv")):
+            continue
+        with open(os.path.join(directory, name), newline="", encoding="utf-8") as batch:
+            reader = csv.reader(batch)
+            header = next(reader, None)
+            if header != COLUMN_NAMES:
+                print("Skipping " + name + ": unexpected columns")
+                continue
+            for row in reader:
+                for column, value in zip(COLUMN_NAMES, row):
+                    columns[column].append(value)
+    columns["line"] = [int(value) for value in columns["line"]]
+    columns["quantity"] = [float(value) for value in columns["quantity"]]
+    return columns
+
+
+def to_array(columns):
+    # A NumPy structured array from the columns
+    if numpy is None:
+        raise RuntimeError("NumPy is not installed; use the CSV batches instead")
+    dtype = numpy.dtype(list(COLUMNS))
+    array = numpy.empty(len(columns["file"]), dtype=dtype)
+    for name, _ in COLUMNS:
+        array[name] = columns[name]
+    return array
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract forecast and schedule lines from EDI files")
+    parser.add_argument("directory", help="where to write the batch")
+    parser.add_argument("files", nargs="+", help="renamed EDI files")
+    parser.add_argument("--format", choices=("csv", "npy"), default="csv",
+                        help="batch file format (default: csv)")
+    args = parser.parse_args()
+    if args.format == "npy" and numpy is None:
+        sys.exit("NumPy is not installed; use --format csv")
+    rows = []
+    for f_path in args.files:
+        if wants(f_path):
+            rows.extend(extract_file(f_path))
+    print(write_batch(args.directory, rows, args.format) + ": " + str(len(rows)) + " rows")
@@ -2,12 +2,36 @@
 # -*- encoding: utf-8 -*-
 
 # Rename EDI files based on ISA and type.
-# Each customer gets their own section, even though there may be 
-#   duplicated functionality.
-# This allows for easier future changes.
+# Each customer gets their own entry in partners.json, so customers can be
+#   added or changed without a code change or a restart.
 
 ###############################################################################
 # Change Log:
+#   * 17-Oct-2026: Single-pass staging dispatcher routed by (syntax, sender ID).
+#                  Auria Old Fort and Auria SPA now have their own functions.
+#                  Type and sender lookups read only the file header.
+#                  Files are read once into an Envelope shared by all lookups.
+#                  X12 delimiters are taken from the ISA; any terminator works.
+#                  EDIFACT honours UNA service string advice and releases.
+#                  Ship From is found by a byte search of the mapped file.
+#                  Optional worker pool; renames applied in order, no clobbering.
+#                  Watch mode (--watch) routes files as they arrive.
+#                  Customers moved to partners.json, reloaded when it changes.
+#                  Optional SQLite classification cache (--cache).
+#                  Added edi_benchmark.py, a corpus generator and benchmark.
+#                  Run metrics as JSON and a Prometheus textfile (--metrics).
+#                  Multi transaction set files can be split first (--split).
+#                  Planned, journaled renames (--journal) and --dry-run.
+#                  Moves work when STAGING and IN are on different volumes.
+#                  .zip and .gz bundles are unpacked straight to IN.
+#                  Optional sharded IN layout (--layout, --flat-view, --migrate).
+#                  STAGING is read in chunks (--chunk-size, --checkpoint).
+#                  830/862 and DELFOR/DELJIT lines can be extracted (--extract).
+#                  Ship From values are also matched inside longer N1/NAD values.
+#                  Re-sent interchanges can be quarantined (--dedupe).
+#                  Acknowledgements are written in the same pass (--acks).
+#                  Resident classify/route service (--serve).
+#                  Files are parsed as bytes; only the values used are decoded.
 #   * 20-Oct-2021: Added OWT/Ryobi, Auria, GA-Howell, GA-Shelby, GA-SPA, GA-AL,
 #                  GATN, GA-Silao, GA-StClair, GA-Marlette
 #   * 12-Oct-2020: Added Autoneum and Navistar
@@ -17,36 +41,46 @@
 ###############################################################################
 
 import os
+import gzip
+import json
+import errno
+import filecmp
+import shutil
+import hashlib
+import zipfile
+import zlib
+import sqlite3
 import re
-import csv
-
-
-# ISA Codes
-cci_isa = "7062282688"
-autoneum_isa = "GLII006"
-husqvarna_isa = "HUSQORNGBRG"
-navistar_isa = "781495650"
-owt_isa = "827942173"
-auriaof_isa = "ONCBUSUPPU"
-auriaspa_isa = "SPSSUSUPPU"
-ga_alabama_isa = "US080765057LBM"
-ga_howell_isa = "609284922"
-ga_shelby_isa = "080647135"
-ga_spartanburg_isa = "US080950568SPA"
-ga_tn_isa = "GA808659114"
-ga_silao_isa = "GAS9403186J1"
-ga_stclair_isa = "US117778503SCL"
-ga_marlette_isa = "GA132713012"
-
-# Ship To Codes
-AURIA_THM = "02054852"
-AURIA_LEX = "02054851"
-AURIA_HOW = "02054850"
+import mmap
+import sys
+import time
+import ctypes
+import select
+import socket
+import struct
+import argparse
+import ipaddress
+import functools
+import threading
+import socketserver
+import urllib.parse
+from stat import S_ISSOCK
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# File Syntax
+X12 = "X12"
+EDIFACT = "EDIFACT"
 
 # File Paths are for Windows OS
 base_dir = os.path.join("M:", "\EDI")
 in_dir = os.path.join(base_dir, "IN")
 staging_dir = os.path.join(base_dir, "IN\STAGING")
+# Renamed files go straight into IN ("flat"), or into IN\TAG\TYPE\DATE
+# ("sharded"). in_flat_view also links each sharded file into IN itself.
+in_layout = "flat"
+in_flat_view = False
 # For testing
 # in_dir_test = os.path.join(base_dir, "_TEST_IN")
 # staging_dir_test = os.path.join(base_dir, "_TEST_STAGING")
@@ -54,885 +88,2692 @@ staging_dir = os.path.join(base_dir, "IN\STAGING")
 # staging_dir = staging_dir_test
 
 
+# Header sniffing
+ISA_SIZE = 106  # The ISA segment is fixed width, terminator included
+UNA_SIZE = 9  # UNA plus its six service characters
+HEADER_SIZE = 512  # Read size; covers the ISA/UNB and the segments after it
+
+# Files are parsed as bytes, and only the values that are used are decoded.
+# EDIFACT declares its character set in the UNB syntax identifier; X12, and
+# EDIFACT without a known identifier, use the partner's "encoding" or
+# DEFAULT_ENCODING. Undecodable bytes are replaced, never an error.
+DEFAULT_ENCODING = "latin-1"
+EDIFACT_CHARSETS = {
+    "UNOA": "ascii", "UNOB": "ascii", "UNOC": "latin-1", "UNOD": "iso8859_2",
+    "UNOE": "iso8859_5", "UNOF": "iso8859_7", "UNOG": "iso8859_3", "UNOH": "iso8859_4",
+    "UNOI": "iso8859_6", "UNOJ": "iso8859_8", "UNOK": "iso8859_9", "UNOW": "utf-8",
+    "UNOY": "utf-8",
+}
+
+
+class Envelope:
+    # Envelope and heading values for one file, read in a single pass
+    __slots__ = (
+        "syntax",           # X12 or EDIFACT
+        "element_sep",      # Data element separator
+        "sub_element_sep",  # Component (sub-element) separator
+        "segment_term",     # Segment terminator
+        "release_char",     # EDIFACT release (escape) character
+        "sender",           # ISA06 / UNB sender
+        "receiver",         # ISA08 / UNB recipient
+        "control_number",   # ISA13 / UNB interchange control reference
+        "group_type",       # GS01 functional identifier
+        "group_control",    # GS06 group control number
+        "doc_type",         # ST01 / UNH message type
+        "doc_control",      # ST02 / UNH message reference
+        "ship_from_name",   # N102 / NAD party name for the SF qualifier
+        "ship_from_code",   # N104 / NAD party id for the SF qualifier
+        "bytes_read",       # Bytes read or searched to fill the envelope
+        "interchange_header",  # ISA elements / UNB elements, for acknowledgements
+        "group_header",     # GS elements
+        "groups",           # [(GS elements, [ST elements])] or [(None, [UNH elements])]
+        "encoding",         # Character set the values were decoded with
+    )
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+
+
+def read_segments(edifile, data, terminator, size=HEADER_SIZE):
+    # Yields the segments of an open file, reading size characters at a time.
+    # data is whatever has already been read from the file.
+    # Only the unfinished tail of the last chunk is held in memory.
+    # Works on text or bytes, as the file was opened.
+    newlines = "\r\n" if isinstance(data, str) else b"\r\n"
+    while True:
+        segments = data.split(terminator)
+        data = segments.pop()
+        for segment in segments:
+            segment = segment.strip(newlines)
+            if segment:
+                yield segment
+        chunk = edifile.read(size)
+        if not chunk:
+            break
+        data += chunk
+    data = data.strip(newlines)
+    if data:
+        yield data
+
+
+def get_delimiters_x12(isa):
+    # Element separator, sub-element separator and segment terminator
+    # from their fixed positions in the ISA segment
+    if len(isa) < ISA_SIZE or isa[:3] not in ("ISA", b"ISA"):
+        raise ValueError("Not an X12 interchange")
+    return isa[3:4], isa[104:105], isa[105:106]
+
+
+def iter_segments_x12(edifile, isa=None, size=HEADER_SIZE):
+    # Yields the segments of an open X12 file as lists of elements.
+    # isa is the ISA segment if it has already been read from the file.
+    # The file is streamed, so callers can stop as soon as they are done.
+    if isa is None:
+        isa = edifile.read(ISA_SIZE)
+    element_sep, sub_element_sep, segment_term = get_delimiters_x12(isa)
+    for segment in read_segments(edifile, isa, segment_term, size):
+        yield segment.split(element_sep)
+
+
+def get_delimiters_edifact(una):
+    # Component separator, data element separator, release character and
+    # segment terminator from the UNA service string advice, or the
+    # defaults when the interchange opens with UNB
+    if una[:3] not in ("UNA", b"UNA"):
+        if isinstance(una, bytes):
+            return b":", b"+", b"?", b"'"
+        return ":", "+", "?", "'"
+    if len(una) < UNA_SIZE:
+        raise ValueError("Incomplete UNA service string advice")
+    release = una[6:7]
+    if release in (" ", b" "):
+        # No release character in use
+        release = None
+    return una[3:4], una[4:5], release, una[8:9]
+
+
+def read_segments_edifact(edifile, data, terminator, release, size=HEADER_SIZE):
+    # read_segments for EDIFACT, where a released terminator is data
+    if not release:
+        yield from read_segments(edifile, data, terminator, size)
+        return
+    if isinstance(terminator, bytes):
+        pattern = re.compile(re.escape(release) + b".|" + re.escape(terminator), re.S)
+        newlines = b"\r\n"
+    else:
+        pattern = re.compile(re.escape(release) + ".|" + re.escape(terminator), re.S)
+        newlines = "\r\n"
+    while True:
+        start = 0
+        for match in pattern.finditer(data):
+            if match.group() == terminator:
+                segment = data[start:match.start()].strip(newlines)
+                if segment:
+                    yield segment
+                start = match.end()
+        data = data[start:]
+        chunk = edifile.read(size)
+        if not chunk:
+            break
+        data += chunk
+    data = data.strip(newlines)
+    if data:
+        yield data
+
+
+def split_segment_edifact(segment, element_sep, component_sep, release):
+    # Splits a segment into elements, each a list of components,
+    # removing release characters
+    if not release or release not in segment:
+        return [element.split(component_sep) for element in segment.split(element_sep)]
+    elements = [[""]]
+    chars = iter(segment)
+    for char in chars:
+        if char == release:
+            elements[-1][-1] += next(chars, "")
+        elif char == element_sep:
+            elements.append([""])
+        elif char == component_sep:
+            elements[-1].append("")
+        else:
+            elements[-1][-1] += char
+    return elements
+
+
+def read_envelope(filename, ship_from_keys=None, list_sets=False):
+    # Reads the envelope and the first transaction set header in one pass,
+    # then looks up the ship from party in the same open file.
+    # ship_from_keys limits the ship from lookup to files whose
+    # (syntax, sender) is listed; None looks it up for every file.
+    # list_sets also lists every group and transaction set header.
+    env = Envelope()
+    with open(filename, "rb") as edifile:
+        read_header(edifile, env)
+        # Bytes read from the file so far, buffering included
+        env.bytes_read = os.lseek(edifile.fileno(), 0, os.SEEK_CUR)
+        if env.syntax is None:
+            return env
+        if ship_from_keys is None or (env.syntax, env.sender) in ship_from_keys:
+            find_ship_from(edifile, env)
+        if list_sets:
+            find_transaction_sets(edifile, env)
+    return env
+
+
+def read_header(edifile, env):
+    # Fills env from the envelope and the first transaction set header of
+    # an open binary stream. Returns the segment iterator, positioned after
+    # the ST/UNH segment, or None when the stream isn't EDI.
+    # Segments are split as bytes; only those read are decoded.
+    data = edifile.read(3)
+    if data == b"ISA":
+        isa = data + edifile.read(ISA_SIZE - len(data))
+        env.syntax = X12
+        env.element_sep, env.sub_element_sep, env.segment_term = [
+            delimiter.decode(DEFAULT_ENCODING) for delimiter in get_delimiters_x12(isa)]
+        segments = ([element.decode(env.encoding or DEFAULT_ENCODING, "replace") for element in row]
+                    for row in iter_segments_x12(edifile, isa))
+        read_envelope_x12(env, segments)
+    elif data in (b"UNA", b"UNB"):
+        data += edifile.read(UNA_SIZE - len(data))
+        env.syntax = EDIFACT
+        component_sep, element_sep, release, segment_term = get_delimiters_edifact(data)
+        env.sub_element_sep = component_sep.decode(DEFAULT_ENCODING)
+        env.element_sep = element_sep.decode(DEFAULT_ENCODING)
+        env.release_char = release and release.decode(DEFAULT_ENCODING)
+        env.segment_term = segment_term.decode(DEFAULT_ENCODING)
+        if data.startswith(b"UNA"):
+            data = data[UNA_SIZE:]
+        # The UNB sets env.encoding for the segments after it
+        segments = (split_segment_edifact(segment.decode(env.encoding or DEFAULT_ENCODING, "replace"),
+                                          env.element_sep, env.sub_element_sep, env.release_char)
+                    for segment in read_segments_edifact(edifile, data, segment_term, release))
+        read_envelope_edifact(env, segments)
+    else:
+        return None
+    if env.encoding is None:
+        partner = ROUTES.get((env.syntax, env.sender))
+        env.encoding = (partner and partner.encoding) or DEFAULT_ENCODING
+    return segments
+
+
+def read_envelope_x12(env, segments):
+    for row in segments:
+        tag = row[0]
+        if tag == "ISA":
+            env.sender = row[6].rstrip()
+            env.receiver = row[8].rstrip()
+            env.control_number = row[13]
+            env.interchange_header = row
+        elif tag == "GS":
+            env.group_type = row[1]
+            env.group_control = row[6]
+            env.group_header = row
+        elif tag == "ST":
+            env.doc_type = row[1]
+            env.doc_control = row[2]
+            return
+
+
+def read_envelope_edifact(env, segments):
+    for line in segments:
+        tag = line[0][0]
+        if tag == "UNB":
+            env.encoding = EDIFACT_CHARSETS.get(line[1][0])
+            env.sender = line[2][0]
+            env.receiver = line[3][0]
+            env.control_number = line[5][0]
+            env.interchange_header = line
+        elif tag == "UNH":
+            env.doc_control = line[1][0]
+            env.doc_type = line[2][0]
+            return
+
+
+def is_released(mm, pos, release):
+    # True when the byte at pos follows an odd number of release characters
+    count = 0
+    while pos - count > 0 and mm[pos - count - 1:pos - count] == release:
+        count += 1
+    return count % 2 == 1
+
+
+def find_segment(mm, tag, term, release=None, start=0):
+    # Byte level search of a memory mapped file for the first segment
+    # starting with tag. Returns the segment bytes, without its terminator,
+    # and the offset the search reached.
+    # Line breaks after the terminator are skipped, unless the terminator
+    # is itself a line break
+    line_breaks = b"".join(byte for byte in (b"\r", b"\n") if byte not in term)
+    pos = mm.find(tag, start)
+    while pos != -1:
+        # The tag must open a segment, not sit inside an element
+        before = mm[max(0, pos - 3):pos]
+        if before.endswith(term) or before.rstrip(line_breaks).endswith(term):
+            end = mm.find(term, pos)
+            while release and end != -1 and is_released(mm, end, release):
+                end = mm.find(term, end + 1)
+            if end == -1:
+                end = len(mm)
+            return mm[pos:end], end
+        pos = mm.find(tag, pos + 1)
+    return None, len(mm)
+
+
+def find_ship_from(edifile, env):
+    # Looks up the N1*SF / NAD+SF party with a byte level search of the
+    # memory mapped file, using the delimiters from the envelope.
+    # Only the matched segment is copied and decoded.
+    if os.fstat(edifile.fileno()).st_size == 0:
+        return
+    encoding = env.encoding
+    sep = env.element_sep.encode(DEFAULT_ENCODING)
+    term = env.segment_term.encode(DEFAULT_ENCODING)
+    with mmap.mmap(edifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if env.syntax == X12:
+            segment, searched = find_segment(mm, b"N1" + sep + b"SF" + sep, term)
+            env.bytes_read = max(env.bytes_read, searched)
+            if segment is None:
+                return
+            row = segment.split(sep)
+            env.ship_from_name = row[2].decode(encoding, "replace")
+            if len(row) > 4:
+                env.ship_from_code = row[4].decode(encoding, "replace")
+        else:
+            release = env.release_char and env.release_char.encode(DEFAULT_ENCODING)
+            segment, searched = find_segment(mm, b"NAD" + sep + b"SF" + sep, term, release)
+            env.bytes_read = max(env.bytes_read, searched)
+            if segment is None:
+                return
+            line = split_segment_edifact(segment.decode(encoding, "replace"), env.element_sep,
+                                         env.sub_element_sep, env.release_char)
+            if len(line) > 2:
+                env.ship_from_code = line[2][0]
+            if len(line) > 4:
+                env.ship_from_name = line[4][0]
+
+
+def find_transaction_sets(edifile, env):
+    # Fills env.groups with the GS and ST, or UNH, segments of the file,
+    # found with a byte level search of the memory mapped file
+    env.groups = []
+    if os.fstat(edifile.fileno()).st_size == 0:
+        return
+    sep = re.escape(env.element_sep.encode(DEFAULT_ENCODING))
+    term = re.escape(env.segment_term.encode(DEFAULT_ENCODING))
+    if env.syntax == X12:
+        tags = b"(?:GS|ST)"
+    else:
+        tags = b"UNH"
+    pattern = re.compile(term + rb"[\r\n]*(" + tags + sep + rb"[^" + term + rb"]*)")
+    with mmap.mmap(edifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for match in pattern.finditer(mm):
+            segment = match.group(1).decode(env.encoding, "replace")
+            if env.syntax == X12:
+                row = segment.split(env.element_sep)
+                if row[0] == "GS":
+                    env.groups.append((row, []))
+                elif env.groups:
+                    env.groups[-1][1].append(row)
+            else:
+                line = split_segment_edifact(segment, env.element_sep, env.sub_element_sep,
+                                             env.release_char)
+                if not env.groups:
+                    env.groups.append((None, []))
+                env.groups[-1][1].append(line)
+        env.bytes_read = max(env.bytes_read, len(mm))
+
+
 def get_isa_x12(filename):
-    with open(filename) as csvfile:
-        csvfile = csvfile.read().split("~")
-        readCSV = csv.reader(csvfile, delimiter="*")
-        for row in readCSV:
-            for idx, cell in enumerate(row):
-                isa = row[idx+6].rstrip()
-                return isa
+    return read_envelope(filename, ()).sender
 
 
 def get_file_type_x12(filename):
     # The cell after the 'ST' segment
-    with open(filename) as csvfile:
-        csvfile = csvfile.read().split('~')
-        readCSV = csv.reader(csvfile, delimiter='*')
-        for row in readCSV:
-            for idx, cell in enumerate(row):
-                if cell == "ST":
-                    st_cell = row[idx+1]
-                    return st_cell
+    return read_envelope(filename, ()).doc_type
 
 
 def get_isa_edifact(filename):
-    line_idx = None
-    with open(filename) as edifile:
-        edifile = edifile.read().split("'")
-        if edifile[0].startswith("UNB"):
-            line_idx = 2
-        if edifile[0].startswith("UNA"):
-            line_idx = 3
-        line = re.split(r'\+', str(edifile))
-        cell = re.split(':', str(line[line_idx]))
-        isa = cell[0]
-        return isa
+    return read_envelope(filename, ()).sender
 
 
 def get_file_type_edifact(filename):
-    line_idx = None
-    with open(filename) as edifile:
-        edifile = edifile.read().split("'")
-        if edifile[0].startswith("UNB"):
-            line_idx = 1
-        if edifile[0].startswith("UNA"):
-            line_idx = 2
-        line = re.split(r'\+', str(edifile[line_idx]))
-        cell = re.split(r':', str(line[2]))
-        file_type = cell[0]
-        return file_type
-
-
-def process_staging_dir():
-    # TODO: Pop renamed files off the filenames stack. Make this one loop.
-    print("\nProcessing files in " + staging_dir)
-
-    print("\nProcessing Husqvarna (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_husq(filename)
-            except:
-                continue
-
-    print("\nProcessing Autoneum (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_autoneum(filename)
-            except:
-                continue
-
-    print("\nProcessing Navistar (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_navistar(filename)
-            except:
-                continue
-
-    print("\nProcessing OWT/Ryobi (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_owt(filename)
-            except:
-                continue
-
-    print("\nProcessing Auria (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_auria(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Howell (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gahowell(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Spartanburg (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gaspa(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Marlette (X12)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gamarlette(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Spartanburg (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gaspa_edifact(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Shelby (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gashelby(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Alabama (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gaalabama(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin TN/KY (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gatn(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin Silao (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gasilao(filename)
-            except:
-                continue
-
-    print("\nProcessing Grupo-Antolin St. Clair (EDIFACT)")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            # Process each file based on customer functions
-            try:
-                rename_file_gastclair(filename)
-            except:
-                continue
-
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        # Move any files left over
-        move_remaining_files(filename)
+    return read_envelope(filename, ()).doc_type
+
+
+class Options:
+    # Settings for a staging run, normally from the command line
+    __slots__ = (
+        "workers",      # Classify files with this many workers, 0 for serial
+        "pool",         # thread or process
+        "cache_file",   # SQLite classification cache, see ClassificationCache
+        "metrics_dir",  # Directory for the run metrics, see RunMetrics
+        "split",        # Split files holding more than one transaction set
+        "interval",     # Seconds between polls in watch mode
+        "journal",      # Plan renames and apply them through this journal file
+        "recover",      # replay or rollback an unfinished journal
+        "dry_run",      # Print the rename plan without applying it
+        "move_workers", # Moves run at once when IN is on another volume
+        "chunk_size",   # Files read from STAGING per batch, 0 for all
+        "checkpoint",   # File recording progress through a large backlog
+        "extract_dir",  # Write forecast and schedule lines here
+        "extract_format",  # csv, or npy for NumPy structured arrays
+        "dedupe_file",  # SQLite index of the interchanges already routed
+        "quarantine_dir",  # Where duplicate interchanges are moved
+        "ack_dir",      # Write 997/999 and CONTRL acknowledgements here
+    )
+
+    def __init__(self, **settings):
+        self.workers = 0
+        self.pool = "thread"
+        self.cache_file = None
+        self.metrics_dir = None
+        self.split = False
+        self.interval = WATCH_INTERVAL
+        self.journal = None
+        self.recover = "replay"
+        self.dry_run = False
+        self.move_workers = 0
+        self.chunk_size = STAGING_CHUNK
+        self.checkpoint = None
+        self.extract_dir = None
+        self.extract_format = "csv"
+        self.dedupe_file = None
+        self.quarantine_dir = os.path.join(base_dir, "QUARANTINE")
+        self.ack_dir = None
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+
+class Classification:
+    # The outcome of classifying one staging file, for the run metrics
+    __slots__ = (
+        "new_filename",   # New file name, None when not renamed
+        "tag",            # Partner tag when a partner matched
+        "reason",         # Why there is no new name
+        "cause",          # Exception type name for a parse failure
+        "bytes_read",     # Bytes read or searched
+        "read_seconds",   # Open and read the envelope
+        "route_seconds",  # Partner lookup and new name
+        "interchange",    # interchange_key of the file, None when not EDI
+        "envelope",       # The Envelope, when acknowledgements are wanted
+        "doc_type",       # ST01 / UNH message type
+    )
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.bytes_read = 0
+        self.read_seconds = self.route_seconds = 0.0
+
+
+def classify_file(f_path):
+    # Works out the new name for a staging file with its customer function.
+    # Returns None when no customer matches or the file can't be read.
+    return classify_file_detail(f_path).new_filename
+
+
+def classify_file_detail(f_path, open_member=None, list_sets=False):
+    # classify_file, recording how the file was classified.
+    # open_member opens a bundle member named f_path instead of the file.
+    # list_sets keeps the envelope, with every transaction set listed, for
+    # the acknowledgements.
+    result = Classification()
+    filename = os.path.basename(f_path)
+    start = time.perf_counter()
+    try:
+        if open_member is None:
+            env = read_envelope(f_path, SHIP_FROM_ROUTES, list_sets)
+            if list_sets:
+                result.envelope = env
+        else:
+            env = read_member_envelope(open_member, SHIP_FROM_ROUTES)
+        result.bytes_read = env.bytes_read
+        read = time.perf_counter()
+        result.read_seconds = read - start
+        partner = ROUTES.get((env.syntax, env.sender))
+        result.interchange = interchange_key(env)
+        result.doc_type = env.doc_type
+        if env.syntax is None:
+            result.reason = "not_edi"
+        elif partner is None:
+            result.reason = "unknown_sender"
+        else:
+            result.tag = partner.tag
+            result.new_filename = rename_file(filename, env, partner)
+            if result.new_filename is None:
+                result.reason = "file_name_format"
+        result.route_seconds = time.perf_counter() - read
+    except Exception as err:
+        result.new_filename = None
+        result.reason = "parse_error"
+        result.cause = type(err).__name__
+    return result
+
+
+def commit_renames(filenames, new_filenames, move_workers=0):
+    # Checks the renames one at a time, in file name order, then moves
+    # the files, move_workers at a time when STAGING and IN are on
+    # different volumes. A file whose new name is already taken stays in
+    # STAGING. Returns the files that were not renamed.
+    remaining = []
+    moves = []
+    targets = set()
+    for filename, new_filename in sorted(zip(filenames, new_filenames), key=lambda item: item[0]):
+        if not new_filename:
+            remaining.append(filename)
+            continue
+        old_filename = os.path.join(staging_dir, filename)
+        new_filename = in_path(new_filename)
+        if new_filename in targets or os.path.exists(new_filename):
+            print("Target already exists: " + old_filename + '  >  ' + new_filename)
+            remaining.append(filename)
+            continue
+        targets.add(new_filename)
+        moves.append((filename, old_filename, new_filename))
+    pairs = [(old_filename, new_filename) for _, old_filename, new_filename in moves]
+    for (filename, old_filename, new_filename), err in zip(moves, move_files(pairs, move_workers)):
+        if err:
+            print("Move failed: " + old_filename + '  >  ' + new_filename + ": " + str(err))
+            remaining.append(filename)
+            continue
+        link_flat_view(new_filename)
+        print(old_filename + '  >  ' + new_filename)
+    return sorted(remaining)
+
+
+POOL_CHUNKSIZE = 32  # Files handed to a process pool worker at a time
+
+
+def make_executor(workers, pool="thread"):
+    # A thread or process pool for classify_file, or None to run serially
+    if not workers:
+        return None
+    if pool == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def process_files(filenames, executor=None, cache=None, metrics=None, options=None,
+                  identities=None, dedupe=None):
+    # Route each file to its customer function by syntax and sender ID.
+    # Files are classified in the executor when there is one; renames are
+    # always applied by this process, in the same order.
+    # Files already classified in the cache are not read again.
+    # identities maps file names to the cache identity from the directory
+    # scan, so those files aren't stat'ed again.
+    # dedupe is a DuplicateIndex; interchanges it has seen are quarantined.
+    # Returns the files left in STAGING.
+    # Bundle members routed straight to IN, as (new file name, envelope)
+    filenames, bundle_routed = unpack_bundles(filenames, metrics, dedupe, options)
+    # The envelopes of split files, by piece, so that acknowledgements
+    # answer the groups as they were sent
+    split_envelopes = {}
+    if options and options.split and not options.dry_run:
+        filenames = split_staging_files(filenames, metrics,
+                                        split_envelopes if options.ack_dir else None)
+    f_paths = [os.path.join(staging_dir, filename) for filename in filenames]
+    new_filenames = [None] * len(f_paths)
+    todo = list(range(len(f_paths)))
+    if cache:
+        todo = cache.lookup(f_paths, new_filenames, identities)
+    if metrics:
+        metrics.files_scanned += len(f_paths)
+        for idx in set(range(len(f_paths))).difference(todo):
+            metrics.add_cached(new_filenames[idx])
+    todo_paths = [f_paths[idx] for idx in todo]
+    classify = classify_file_detail
+    if options and options.ack_dir:
+        classify = functools.partial(classify_file_detail, list_sets=True)
+    if executor:
+        classified = executor.map(classify, todo_paths, chunksize=POOL_CHUNKSIZE)
     else:
-        print("No files found")
-
-
-def move_remaining_files(filename):
-    # Move any remaining files from STAGING to IN
+        classified = map(classify, todo_paths)
+    keys = [None] * len(f_paths)
+    envelopes = {}
+    for idx, result in zip(todo, classified):
+        new_filenames[idx] = result.new_filename
+        keys[idx] = result.interchange
+        if result.envelope:
+            envelopes[filenames[idx]] = result.envelope
+        if metrics:
+            metrics.add(result)
+    if cache:
+        cache.store(todo_paths, [new_filenames[idx] for idx in todo], identities)
+    if dedupe and not (options and options.dry_run):
+        filenames, new_filenames, keys = quarantine_duplicates(
+            dedupe, filenames, new_filenames, keys, set(todo), options, metrics)
+
+    start = time.perf_counter()
+    left = []
+    if options and (options.dry_run or options.journal):
+        plan, skipped = plan_renames(filenames, new_filenames)
+        remaining = [os.path.basename(old) for old, new in plan
+                     if os.path.basename(old) == os.path.basename(new)]
+        if options.dry_run:
+            print_plan(plan, skipped)
+            return filenames
+        failed = apply_plan(plan, options.journal, options.move_workers)
+        for filename in skipped:
+            print("Target already exists, left in STAGING: " + filename)
+        left = skipped + failed
+    else:
+        remaining = commit_renames(filenames, new_filenames, options.move_workers if options else 0)
+        if remaining:
+            # Move any files left over
+            left = move_remaining_files(remaining)
+    if metrics:
+        metrics.files_remaining += len(remaining)
+        metrics.stage_seconds["rename"] += time.perf_counter() - start
+    if cache:
+        cache.discard(f_paths)
+    if dedupe:
+        # Only the files that reached IN; those left in STAGING are checked
+        # again on the next run
+        dedupe.add([key for filename, key in zip(filenames, keys) if key and filename not in left])
+    not_renamed = set(remaining).union(left)
+    if options and options.extract_dir:
+        extract_renamed([new_filename for filename, new_filename in zip(filenames, new_filenames)
+                         if new_filename and filename not in not_renamed]
+                        + [new_filename for new_filename, _ in bundle_routed], options, metrics)
+    if options and options.ack_dir:
+        routed = [(filename, new_filename) for filename, new_filename in zip(filenames, new_filenames)
+                  if new_filename and filename not in not_renamed]
+        ack_envelopes = []
+        acked = set()  # ids of the split envelopes already listed
+        for filename, new_filename in routed:
+            env = split_envelopes.get(filename)
+            if env is None:
+                env = envelopes.get(filename) or read_envelope(in_path(new_filename), (), True)
+            elif id(env) in acked:
+                # Acknowledged with an earlier piece of the same file
+                continue
+            else:
+                acked.add(id(env))
+            ack_envelopes.append(env)
+        ack_envelopes += [env for _, env in bundle_routed]
+        write_acks(ack_envelopes, options, metrics)
+    return left
+
+
+def extract_renamed(new_filenames, options, metrics=None):
+    # Writes the forecast and schedule lines of the renamed files to one
+    # batch in options.extract_dir. A file that can't be read is skipped.
+    import edi_extract  # Only loaded when the stage is used
+    rows = []
+    start = time.perf_counter()
+    for new_filename in new_filenames:
+        if not edi_extract.wants(new_filename):
+            continue
+        try:
+            rows.extend(edi_extract.extract_file(in_path(new_filename), new_filename))
+        except (OSError, ValueError, IndexError) as err:
+            print("Could not extract " + new_filename + ": " + str(err))
+    if rows:
+        edi_extract.write_batch(options.extract_dir, rows, options.extract_format)
+    if metrics:
+        metrics.lines_extracted += len(rows)
+        metrics.stage_seconds["extract"] += time.perf_counter() - start
+
+
+def process_staging_dir(options=None):
+    # options.workers > 0 classifies files concurrently in a thread or
+    # process pool. options.cache_file keeps classifications across runs.
+    # options.metrics_dir gets the run metrics as JSON and a Prometheus
+    # textfile. options.split splits multi transaction set files first.
+    # STAGING is read options.chunk_size files at a time, so memory use
+    # doesn't grow with the backlog. options.checkpoint lets a run that
+    # is stopped part way resume without going over the same files.
+    options = options or Options()
+    print("\nProcessing files in " + staging_dir)
+    if options.journal:
+        recover_journal(options.journal, options.recover, options.dry_run)
+
+    metrics = RunMetrics() if options.metrics_dir else None
+    start = time.perf_counter()
+    cache = ClassificationCache(options.cache_file) if options.cache_file else None
+    dedupe = DuplicateIndex(options.dedupe_file) if options.dedupe_file else None
+    left = load_checkpoint(options.checkpoint)
+    executor = make_executor(options.workers, options.pool)
+    try:
+        found = False
+        if cache:
+            cache.start_prune()
+        for chunk in iter_staging_chunks(options.chunk_size, left, metrics):
+            found = True
+            if cache:
+                cache.mark_present([os.path.join(staging_dir, name) for name in chunk])
+            left.update(process_files(list(chunk), executor, cache, metrics, options, chunk,
+                                      dedupe))
+            save_checkpoint(options.checkpoint, left)
+        if cache:
+            # Forget files that have left STAGING since the last run
+            cache.finish_prune()
+        if not found:
+            print("No files found")
+        remove_checkpoint(options.checkpoint)
+    finally:
+        if executor:
+            executor.shutdown()
+        if cache:
+            cache.close()
+        if dedupe:
+            dedupe.close()
+        if metrics:
+            metrics.run_seconds = time.perf_counter() - start
+            metrics.write(options.metrics_dir)
+
+
+def move_remaining_files(filenames):
+    # Move any remaining files from STAGING to IN. A file whose name is
+    # already taken in IN, or that can't be moved, stays in STAGING.
+    # Returns the files left in STAGING.
     print("\nMoving remaining files")
-    filenames = os.listdir(staging_dir)
-    if filenames:
-        for filename in filenames:
-            old_filename = os.path.join(staging_dir, filename)
-            new_filename = os.path.join(in_dir, filename)
-            # new_filename = os.path.join(staging_dir_test, filename)
+    left = []
+    for filename in filenames:
+        old_filename = os.path.join(staging_dir, filename)
+        new_filename = os.path.join(in_dir, filename)
+        # new_filename = os.path.join(staging_dir_test, filename)
+        if os.path.exists(new_filename):
+            print("Target already exists, left in STAGING: " + old_filename)
+            left.append(filename)
+            continue
+        try:
+            move_file(old_filename, new_filename)
+        except OSError as err:
+            print("Move failed, left in STAGING: " + old_filename + ": " + str(err))
+            left.append(filename)
+            continue
+        print(old_filename + '  >  ' + new_filename)
+    return left
+
+
+###############################################################################
+# Move Backend Begin
+# STAGING and IN may be on different volumes (local disk and the share), where
+# os.rename fails with EXDEV. Those files are copied in the kernel, synced,
+# verified and only then removed from STAGING.
+###############################################################################
+MOVE_VERIFY = "size"      # "size" or "sha256"
+COPY_CHUNK = 8 * 1024 * 1024
+PART_SUFFIX = ".part"
+
+
+def copy_file_data(src_fd, dst_fd, size):
+    # Copies size bytes with copy_file_range, then sendfile, then plain
+    # reads and writes, whichever the kernel and file systems support.
+    copied = 0
+    for copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if copy is None:
+            continue
+        try:
+            while copied < size:
+                if copy is os.sendfile:
+                    sent = copy(dst_fd, src_fd, copied, min(COPY_CHUNK, size - copied))
+                else:
+                    sent = copy(src_fd, dst_fd, min(COPY_CHUNK, size - copied), copied, copied)
+                if not sent:
+                    break
+                copied += sent
+            return copied
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or copied:
+                raise
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    while True:
+        chunk = os.read(src_fd, COPY_CHUNK)
+        if not chunk:
+            return copied
+        os.write(dst_fd, chunk)
+        copied += len(chunk)
+
+
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def move_file(old_filename, new_filename):
+    # os.rename when both names are on one volume. Otherwise the data goes
+    # to new_filename + ".part", which is synced, checked and renamed into
+    # place before old_filename is removed, so IN never sees half a file.
+    try:
+        try:
+            os.rename(old_filename, new_filename)
+        except FileNotFoundError:
+            # A new shard directory in IN
+            target_dir = os.path.dirname(new_filename)
+            if not os.path.exists(old_filename) or os.path.isdir(target_dir):
+                raise
+            os.makedirs(target_dir, exist_ok=True)
             os.rename(old_filename, new_filename)
-            print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-###############################################################################
-# X12 Format Files
-###############################################################################
-###############################################################################
-
-###############################################################################
-# CCI (X12) Begin
-###############################################################################
-def rename_file_cci(filename):
-    
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in CCI format.
-    if not f.startswith("TP"):
-        # Not a CCI file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != cci_isa:
         return
-
-    new_filename = "CCI" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# CCI End
-###############################################################################
-
-###############################################################################
-# Husqvarna (X12) Begin
-###############################################################################
-def get_ship_from_husq(filename):
-    filename = os.path.join(staging_dir, filename)
-    with open(filename) as csvfile:
-        csvfile = csvfile.read().split('~')
-        readCSV = csv.reader(csvfile, delimiter='*')
-        for row in readCSV:
-            for idx, cell in enumerate(row):
-                if cell == "SF":
-                    sf_cell = row[idx+1]
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    part_filename = new_filename + PART_SUFFIX
+    src_fd = os.open(old_filename, os.O_RDONLY)
     try:
-        if sf_cell == "THOMSON PLASTICS":
-            sf = "THM"
-        if sf_cell == "THOMSON PLAS. LEXINGTON":
-            sf = "LEX"
-    except:
-        print("Ship From not found in file")
-        sf = "MISSING"
-    return sf
-
-
-def rename_file_husq(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != husqvarna_isa:
-        return
-
-    # Get Ship From location from 850s and 860s only
-    if f_type == "850" or f_type == "860":
-        sf = get_ship_from_husq(f_path)
-        new_filename = "HUSQ" + sep + sf + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    else:
-        new_filename = "HUSQ" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    # new_filename = os.path.join(staging_dir_test, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Husqvarna End
-###############################################################################
-
-###############################################################################
-# Autoneum (X12) Begin
-###############################################################################
-def rename_file_autoneum(filename):
-    # Ship From: 140472
-    # Ship To Locations
-    # THM Only: US03
-    # HOW Only: MX02, US02
-    # Both THM and HOW use US01
-
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != autoneum_isa:
-        return
-
-    new_filename = "AUTONEUM" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Autoneum End
-###############################################################################
-
-###############################################################################
-# Navistar (X12) Begin
-###############################################################################
-def rename_file_navistar(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != navistar_isa:
-        return
-
-    new_filename = "NAVISTAR" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Navistar End
-###############################################################################
-
-###############################################################################
-# OWT/TTI/Ryobi (X12) Begin
-###############################################################################
-def rename_file_owt(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != owt_isa:
-        return
-
-    new_filename = "OWT" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# OWT/TTI/Ryobi End
-###############################################################################
-
-###############################################################################
-# Auria Old Fort (X12) Begin
-###############################################################################
-def get_ship_from_auria(filename):
-    filename = os.path.join(staging_dir, filename)
-    with open(filename) as csvfile:
-        csvfile = csvfile.read().split('~')
-        readCSV = csv.reader(csvfile, delimiter='*')
-        for row in readCSV:
-            for idx, cell in enumerate(row):
-                if cell == "SF":
-                    sf_cell = row[idx+3]
-
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(part_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copied = copy_file_data(src_fd, dst_fd, size)
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
     try:
-        if sf_cell == AURIA_HOW:
-            sf = "HOW"
-        if sf_cell == AURIA_LEX:
-            sf = "LEX"
-        if sf_cell == AURIA_THM:
-            sf = "THM"
-    except:
-        print("Ship From not found in file")
-        sf = "MISSING"
-    return sf
-
-
-def rename_file_auria(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
-
-    isa = get_isa_x12(f_path)
-    if isa != auriaof_isa:
+        if copied != size or os.path.getsize(part_filename) != size:
+            raise OSError(errno.EIO, "Copy is %d bytes, expected %d" % (copied, size), part_filename)
+        if MOVE_VERIFY == "sha256" and file_digest(part_filename) != file_digest(old_filename):
+            raise OSError(errno.EIO, "Copy does not match the original", part_filename)
+        os.rename(part_filename, new_filename)
+    except OSError:
+        os.remove(part_filename)
+        raise
+    os.remove(old_filename)
+
+
+def try_move_file(pair):
+    # move_file for an executor: the error comes back instead of raising
+    try:
+        move_file(*pair)
+    except OSError as err:
+        return err
+    return None
+
+
+def move_files(pairs, workers=0):
+    # Moves each (old, new) pair and yields its error or None, in order.
+    # workers > 0 runs that many moves at once, so one slow copy to the
+    # share does not hold up the rest of the batch.
+    if not workers or len(pairs) < 2:
+        yield from map(try_move_file, pairs)
         return
-    sf = get_ship_from_auria(f_path)
-    new_filename = "AURIAOF" + sep + sf + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Auria Old Fort End
-###############################################################################
-
-###############################################################################
-# Auria SPA (X12) Begin
-###############################################################################
-def get_ship_from_auria(filename):
-    filename = os.path.join(staging_dir, filename)
-    with open(filename) as csvfile:
-        csvfile = csvfile.read().split('~')
-        readCSV = csv.reader(csvfile, delimiter='*')
-        for row in readCSV:
-            for idx, cell in enumerate(row):
-                if cell == "SF":
-                    sf_cell = row[idx+3]
-
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(try_move_file, pairs)
+###############################################################################
+# Move Backend End
+###############################################################################
+
+
+###############################################################################
+# Partner Registry Begin
+# Each customer is an entry in partners.json. The entries are compiled into
+# lookup tables at startup and reloaded when the file changes.
+###############################################################################
+PARTNERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "partners.json")
+
+ROUTES = {}  # (syntax, sender ID) > Partner
+SHIP_FROM_ROUTES = set()  # (syntax, sender ID) of partners that need the Ship From
+PARTNERS_STAMP = None  # (size, mtime) of the loaded partners file
+SHIP_FROM_MATCHER = None  # ShipFromMatcher over every partner's Ship From values
+
+
+class Partner:
+    # One customer entry from the partners file
+    __slots__ = (
+        "name",             # Customer name, for messages
+        "syntax",           # X12 or EDIFACT
+        "sender",           # ISA06 / UNB sender
+        "prefix",           # Staging file name prefix, 1027 for ECGrid
+        "tag",              # First part of the new file name
+        "ship_from_element",  # name or code, the N1/NAD value to look up
+        "ship_from_types",  # Document types that include the Ship From, None for all
+        "ship_from_codes",  # N1/NAD value > Ship From code for the file name
+        "ack",              # 997, 999 or CONTRL, True to choose by syntax, False for none
+        "encoding",         # Character set when the file doesn't declare one
+    )
+
+    def __init__(self, entry):
+        self.name = entry.get("name", entry["tag"])
+        self.syntax = entry["syntax"]
+        self.sender = entry["sender"]
+        self.prefix = entry["prefix"]
+        self.tag = entry["tag"]
+        self.ack = entry.get("ack", True)
+        self.encoding = entry.get("encoding")
+        if self.ack not in (True, False, "997", "999", "CONTRL"):
+            raise ValueError(self.name + ": ack must be 997, 999, CONTRL, true or false")
+        ship_from = entry.get("ship_from")
+        if ship_from:
+            self.ship_from_element = ship_from["element"]
+            self.ship_from_types = ship_from.get("types")
+            self.ship_from_codes = dict(ship_from["codes"])
+            if self.ship_from_element not in ("name", "code"):
+                raise ValueError(self.name + ": ship_from element must be name or code")
+        else:
+            self.ship_from_element = None
+            self.ship_from_types = None
+            self.ship_from_codes = None
+        if self.syntax not in (X12, EDIFACT):
+            raise ValueError(self.name + ": unknown syntax " + self.syntax)
+
+
+class ShipFromMatcher:
+    # Aho-Corasick automaton over the Ship From names and codes of every
+    # partner. One pass over an N1/NAD value finds all the known values in
+    # it, however many partners and plants there are.
+    __slots__ = ("goto", "fail", "out")
+
+    def __init__(self, patterns):
+        # patterns are (text, (syntax, sender ID), Ship From code)
+        self.goto = [{}]
+        self.out = [[]]
+        for text, key, code in patterns:
+            node = 0
+            for char in text:
+                nxt = self.goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][char] = nxt
+                    self.goto.append({})
+                    self.out.append([])
+                node = nxt
+            self.out[node].append((len(text), key, code))
+        # Failure links, breadth first
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        # Yields (start, end, key, code) for every known value in text
+        node = 0
+        for pos, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for length, key, code in self.out[node]:
+                yield pos + 1 - length, pos + 1, key, code
+
+    def resolve(self, text, key):
+        # The Ship From code of the longest whole word value of partner
+        # key in text, or None when there is none or the plants disagree
+        best = None
+        codes = set()
+        for start, end, match_key, code in self.search(text):
+            if match_key != key:
+                continue
+            if (start and text[start - 1].isalnum()) or (end < len(text) and text[end].isalnum()):
+                continue
+            codes.add(code)
+            if best is None or end - start > best[0]:
+                best = (end - start, code)
+        if best is None or len(codes) > 1:
+            return None
+        return best[1]
+
+
+def load_partners(path=PARTNERS_FILE):
+    # Compiles the partners file into the ROUTES and SHIP_FROM_ROUTES tables
+    # and the ShipFromMatcher
+    with open(path, encoding="utf-8") as partners_file:
+        entries = json.load(partners_file)["partners"]
+    routes = {}
+    ship_from_routes = set()
+    for entry in entries:
+        if not entry.get("enabled", True):
+            continue
+        partner = Partner(entry)
+        key = (partner.syntax, partner.sender)
+        if key in routes:
+            raise ValueError(partner.name + ": duplicate sender " + partner.sender)
+        routes[key] = partner
+        if partner.ship_from_codes is not None:
+            ship_from_routes.add(key)
+    matcher = ShipFromMatcher((value, key, code) for key in ship_from_routes
+                              for value, code in routes[key].ship_from_codes.items())
+    return routes, ship_from_routes, matcher
+
+
+def reload_partners(path=PARTNERS_FILE):
+    # Reloads the partner tables if the partners file has changed.
+    # Returns True when the tables were replaced. A file that fails to load
+    # leaves the current tables in place.
+    global ROUTES, SHIP_FROM_ROUTES, SHIP_FROM_MATCHER, PARTNERS_STAMP
+    stamp = None
     try:
-        if sf_cell == AURIA_HOW:
-            sf = "HOW"
-        if sf_cell == AURIA_LEX:
-            sf = "LEX"
-        if sf_cell == AURIA_THM:
-            sf = "THM"
-    except:
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        if stamp == PARTNERS_STAMP:
+            return False
+        routes, ship_from_routes, matcher = load_partners(path)
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        if PARTNERS_STAMP is None:
+            raise
+        print("Partners file not reloaded: " + repr(err))
+        if stamp:
+            # Don't retry until the file changes again
+            PARTNERS_STAMP = stamp
+        return False
+    if PARTNERS_STAMP is not None:
+        print("Reloaded " + str(len(routes)) + " partners from " + path)
+    ROUTES, SHIP_FROM_ROUTES, PARTNERS_STAMP = routes, ship_from_routes, stamp
+    SHIP_FROM_MATCHER = matcher
+    return True
+
+
+def get_ship_from(env, partner):
+    # Ship From code for the file name, from the N1*SF or NAD+SF value.
+    # A value that isn't listed exactly, such as "THOMSON PLASTICS INC",
+    # is resolved by the known value it contains. An unknown value raises
+    # KeyError and the file is left for move_remaining_files.
+    if partner.ship_from_element == "name":
+        sf_cell = env.ship_from_name
+    else:
+        sf_cell = env.ship_from_code
+    if sf_cell is None:
         print("Ship From not found in file")
-        sf = "MISSING"
-    return sf
+        return "MISSING"
+    code = partner.ship_from_codes.get(sf_cell)
+    if code is None:
+        code = SHIP_FROM_MATCHER.resolve(sf_cell, (partner.syntax, partner.sender))
+        if code is None:
+            raise KeyError(sf_cell)
+    return code
 
 
-def rename_file_auria(filename):
+def rename_file(filename, env, partner):
+    # Returns the new file name, or None when the file isn't the partner's
     f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
 
-    # Check if in ECGrid format.
+    # Check the file name format.
     # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
+    # CCI file format: TP-20201006-0001.edi
+    if not f.startswith(partner.prefix):
         return
 
     sep = "-" # File separator
     f_ext = ".edi"  # File extension
     f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
+    f_list = f.split(sep)  # Make a list from the split
     f_date = f_list[1]  # The second piece is the date code
     f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
+    f_type = env.doc_type
 
-    isa = get_isa_x12(f_path)
-    if isa != auriaspa_isa:
+    if env.syntax != partner.syntax or env.sender != partner.sender:
         return
-    sf = get_ship_from_auria(f_path)
-    new_filename = "AURIASPA" + sep + sf + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Auria SPA End
-###############################################################################
 
+    # Get Ship From location for the listed types, or all types if none are
+    if partner.ship_from_codes is not None and (
+            partner.ship_from_types is None or f_type in partner.ship_from_types):
+        sf = get_ship_from(env, partner)
+        new_filename = partner.tag + sep + sf + sep + f_type + sep + f_date + sep + f_idx + f_ext
+    else:
+        new_filename = partner.tag + sep + f_type + sep + f_date + sep + f_idx + f_ext
+    return new_filename
 ###############################################################################
-# Grupo-Antolin Howell (X12) Begin
+# Partner Registry End
 ###############################################################################
-def rename_file_gahowell(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
-
 
-    isa = get_isa_x12(f_path)
-    if isa != ga_howell_isa:
-        return
 
-    new_filename = "GAHOWELL" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
 ###############################################################################
-# Grupo-Antolin Howell End
+# IN Layout Begin
+# With tens of thousands of files in one directory, listing and opening files
+# on the share slows down. The sharded layout files each renamed file under
+# IN\TAG\TYPE\DATE, using the parts rename_file put in its name.
 ###############################################################################
+IN_LAYOUTS = ("flat", "sharded")
 
-###############################################################################
-# Grupo-Antolin Spartanburg (X12) Begin
-###############################################################################
-def rename_file_gaspa(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
 
+def shard_parts(new_filename):
+    # (tag, type, date) from TAG[-SF]-TYPE-DATE-IDX.edi, or None when the
+    # name isn't one rename_file builds. The date is cut to the day.
+    base, ext = os.path.splitext(new_filename)
+    parts = base.split("-")
+    if ext.lower() != ".edi" or len(parts) not in (4, 5):
+        return None
+    tag, f_type, f_date = parts[0], parts[-3], parts[-2]
+    if not f_date.isdigit() or len(f_date) < 8:
+        return None
+    return tag, f_type, f_date[:8]
 
-    isa = get_isa_x12(f_path)
-    if isa != ga_spartanburg_isa:
-        return
-
-    new_filename = "GASPA" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-###############################################################################
-# Grupo-Antolin Spartanburg End
-###############################################################################
-
-###############################################################################
-# Grupo-Antolin Marlette (X12) Begin
-###############################################################################
-def rename_file_gamarlette(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
 
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_x12(f_path)
+def in_path(new_filename, layout=None):
+    # Where a renamed file goes in IN
+    parts = shard_parts(new_filename) if (layout or in_layout) == "sharded" else None
+    if parts is None:
+        return os.path.join(in_dir, new_filename)
+    return os.path.join(in_dir, *parts, new_filename)
 
 
-    isa = get_isa_x12(f_path)
-    if isa != ga_marlette_isa:
+def link_flat_view(path):
+    # Hard links a sharded file into IN under its own name, for consumers
+    # that still read IN flat. A name already taken there is left alone.
+    if not in_flat_view or os.path.dirname(path) == in_dir:
         return
-
-    new_filename = "GAMARLETTE" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
+    flat_path = os.path.join(in_dir, os.path.basename(path))
+    try:
+        os.link(path, flat_path)
+    except OSError as err:
+        print("Flat view link failed: " + flat_path + ": " + str(err))
+
+
+def migrate_in_dir(layout="sharded"):
+    # Moves the renamed files already in IN to where layout puts them.
+    # Files rename_file didn't name, and STAGING, stay where they are.
+    # Going back to "flat" gathers the sharded files into IN again; only
+    # files in the IN\TAG\TYPE\DATE folder their own name gives are moved,
+    # so other folders under IN are left alone.
+    print("\nMigrating " + in_dir + " to the " + layout + " layout")
+    moved = 0
+    if layout == "sharded":
+        with os.scandir(in_dir) as entries:
+            paths = [entry.path for entry in entries if entry.is_file(follow_symlinks=False)]
+    else:
+        paths = []
+        for root, dirs, files in os.walk(in_dir):
+            if root == in_dir:
+                dirs[:] = [d for d in dirs if os.path.join(root, d) != staging_dir]
+                continue
+            if os.path.relpath(root, in_dir).count(os.sep) >= 2:
+                # IN\TAG\TYPE\DATE is as deep as the shards go
+                dirs[:] = []
+            paths.extend(os.path.join(root, filename) for filename in files
+                         if shard_parts(filename) is not None
+                         and os.path.dirname(in_path(filename, "sharded")) == root)
+    for path in sorted(paths):
+        filename = os.path.basename(path)
+        if shard_parts(filename) is None:
+            continue
+        new_path = in_path(filename, layout)
+        if new_path == path:
+            continue
+        if os.path.exists(new_path):
+            if layout == "flat" and os.path.samefile(path, new_path):
+                # Already there through the flat view
+                os.remove(path)
+                continue
+            print("Target already exists: " + path + '  >  ' + new_path)
+            continue
+        move_file(path, new_path)
+        if layout == "sharded":
+            link_flat_view(new_path)
+        moved += 1
+        print(path + '  >  ' + new_path)
+    print(str(moved) + " files moved")
+    return moved
 ###############################################################################
-# Grupo-Antolin Marlette End
+# IN Layout End
 ###############################################################################
 
 
 ###############################################################################
+# Staging Scan Begin
+# After a VAN outage STAGING can hold 100k+ files. The directory is read as a
+# stream and handled in chunks, with progress kept in a checkpoint file.
 ###############################################################################
-# EDIFACT Format Files
-###############################################################################
-###############################################################################
+STAGING_CHUNK = 1000  # Files per batch in process_staging_dir
 
-###############################################################################
-# Grupo-Antolin Spartanburg (EDIFACT) Begin
-###############################################################################
-def rename_file_gaspa_edifact(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
 
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
+def iter_staging_chunks(size, skip=(), metrics=None):
+    # Yields dicts of up to size file names (all of them when size is 0)
+    # mapping to the cache identity from the DirEntry, whose stat data
+    # comes with the listing on Windows. Names in skip, and files still
+    # being written under a temporary name, are passed over.
+    # Each chunk is processed before the scan reads on, so a file moved
+    # out of STAGING is not listed again.
+    chunk = {}
+    start = time.perf_counter()
+    with os.scandir(staging_dir) as entries:
+        for entry in entries:
+            if entry.name in skip or entry.name.endswith(PART_SUFFIX):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                chunk[entry.name] = (stat.st_size, stat.st_mtime_ns, entry.inode())
+            except OSError:
+                # Gone since the listing
+                continue
+            if size and len(chunk) >= size:
+                if metrics:
+                    metrics.stage_seconds["list"] += time.perf_counter() - start
+                yield chunk
+                chunk = {}
+                start = time.perf_counter()
+    if metrics:
+        metrics.stage_seconds["list"] += time.perf_counter() - start
+    if chunk:
+        yield chunk
+
+
+def load_checkpoint(path):
+    # The files an unfinished run left in STAGING, to be passed over
+    if not path:
+        return set()
+    try:
+        with open(path, encoding="utf-8") as checkpoint:
+            state = json.load(checkpoint)
+    except FileNotFoundError:
+        return set()
+    except ValueError:
+        print("Ignoring unreadable checkpoint " + path)
+        return set()
+    print("Resuming from checkpoint " + path)
+    return set(state["left"])
+
+
+def save_checkpoint(path, left):
+    # Written through a temporary name after each chunk
+    if not path:
         return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
+    with open(path + ".tmp", "w", encoding="utf-8") as checkpoint:
+        json.dump({"left": sorted(left), "saved": time.time()}, checkpoint)
+    os.replace(path + ".tmp", path)
+
+
+def remove_checkpoint(path):
+    # The scan reached the end of STAGING
+    if path and os.path.exists(path):
+        os.remove(path)
+###############################################################################
+# Staging Scan End
+###############################################################################
+
+
+###############################################################################
+# Rename Plan and Journal Begin
+# Two phase renames: the whole batch is planned first, then applied through
+# a write-ahead journal that a restart can replay or roll back.
+###############################################################################
+PLAN_LIST_MIN = 64  # Files for one directory before it is listed, not stat'ed
+
+
+def plan_renames(filenames, new_filenames):
+    # The renames for a batch as (old path, new path) pairs, grouped by
+    # target directory. A file whose new name is taken falls back to its
+    # own name, as move_remaining_files would. A file whose own name is
+    # taken too is left in STAGING and returned in skipped.
+    # Large batches list each target directory once instead of checking
+    # every name on the share.
+    use_listing = len(filenames) >= PLAN_LIST_MIN
+    taken = {}  # Target directory > names there or already planned
+
+    def is_taken(new_path):
+        directory, name = os.path.split(new_path)
+        if directory not in taken:
+            taken[directory] = set()
+            if use_listing and os.path.isdir(directory):
+                taken[directory] = set(os.listdir(directory))
+        if name in taken[directory] or (not use_listing and os.path.exists(new_path)):
+            return True
+        taken[directory].add(name)
+        return False
+
+    plan = []
+    skipped = []
+    for filename, new_filename in sorted(zip(filenames, new_filenames), key=lambda item: item[0]):
+        old_filename = os.path.join(staging_dir, filename)
+        candidates = [in_path(new_filename)] if new_filename else []
+        candidates.append(os.path.join(in_dir, filename))
+        for new_path in candidates:
+            if not is_taken(new_path):
+                plan.append((old_filename, new_path))
+                break
+        else:
+            skipped.append(filename)
+    plan.sort(key=lambda item: (os.path.dirname(item[1]), item[0]))
+    return plan, skipped
+
+
+def print_plan(plan, skipped):
+    print("\nPlanned renames (dry run)")
+    for old_filename, new_filename in plan:
+        print(old_filename + '  >  ' + new_filename)
+    for filename in skipped:
+        print("Target already exists, left in STAGING: " + filename)
+
+
+def apply_plan(plan, journal_file, move_workers=0):
+    # Syncs the plan to the journal before the first rename, and records
+    # each rename as it is done. The journal is removed once every rename
+    # has been tried. A rename that fails leaves the file in STAGING.
+    # Returns the names of the files whose rename failed.
+    failed = []
+    with open(journal_file, "w", encoding="utf-8") as journal:
+        journal.write(json.dumps({"plan": plan}) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+        for idx, ((old_filename, new_filename), err) in enumerate(zip(plan, move_files(plan, move_workers))):
+            if err:
+                print("Rename failed: " + old_filename + '  >  ' + new_filename + ": " + str(err))
+                journal.write(json.dumps({"failed": idx}) + "\n")
+                failed.append(os.path.basename(old_filename))
+                continue
+            journal.write(json.dumps({"done": idx}) + "\n")
+            link_flat_view(new_filename)
+            print(old_filename + '  >  ' + new_filename)
+        journal.write(json.dumps({"commit": True}) + "\n")
+        journal.flush()
+    os.remove(journal_file)
+    return failed
 
 
-    isa = get_isa_edifact(f_path)
-    if isa != ga_spartanburg_isa:
+def recover_journal(journal_file, mode="replay", dry_run=False):
+    # Finishes (replay) or undoes (rollback) the plan in a journal left by
+    # a run that stopped part way. Each entry is checked against the files
+    # on disk, so recovering twice is safe. dry_run only prints the moves
+    # recovery would make, and leaves the journal in place.
+    try:
+        with open(journal_file, encoding="utf-8") as journal:
+            records = [json.loads(line) for line in journal if line.strip()]
+    except FileNotFoundError:
         return
-
-    new_filename = "GASPA" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-# Grupo-Antolin Spartanburg End
-###############################################################################
-
-###############################################################################
-# Grupo-Antolin Shelby (EDIFACT) Begin
-###############################################################################
-def rename_file_gashelby(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
+    except ValueError:
+        # The last record was cut short; everything before it is good
+        with open(journal_file, encoding="utf-8") as journal:
+            lines = journal.read().splitlines()
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    if not records or "plan" not in records[0]:
+        # The plan never reached the disk, so nothing was renamed
+        if not dry_run:
+            os.remove(journal_file)
         return
-
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
-
-
-    isa = get_isa_edifact(f_path)
-    if isa != ga_shelby_isa:
+    if not any(record.get("commit") for record in records):
+        print("\nRecovering unfinished journal " + journal_file + " (" + mode
+              + (", dry run" if dry_run else "") + ")")
+        for old_filename, new_filename in records[0]["plan"]:
+            if mode == "rollback":
+                source, target = new_filename, old_filename
+            else:
+                source, target = old_filename, new_filename
+            if os.path.exists(source) and not os.path.exists(target):
+                if not dry_run:
+                    move_file(source, target)
+                print(source + '  >  ' + target)
+    if not dry_run:
+        os.remove(journal_file)
+###############################################################################
+# Rename Plan and Journal End
+###############################################################################
+
+
+###############################################################################
+# Bundles Begin
+# A .zip or .gz bundle from the VAN is read in place. Each member is classified
+# from a stream of its header and written once, under its new name, to IN.
+# With --split or --journal the members are unpacked to STAGING instead and
+# routed with the rest of the batch, so they are split and journalled too.
+# --dry-run prints where each member would go.
+###############################################################################
+BUNDLE_EXTENSIONS = (".zip", ".gz")
+
+
+def is_bundle(filename):
+    return filename.lower().endswith(BUNDLE_EXTENSIONS)
+
+
+def read_member_envelope(open_member, ship_from_keys=None):
+    # read_envelope for a bundle member. The member is decompressed as a
+    # stream and the ship from lookup carries on through the same segment
+    # iterator, so only the unfinished segment is held in memory.
+    env = Envelope()
+    with open_member() as member:
+        segments = read_header(member, env)
+        if segments is not None and (
+                ship_from_keys is None or (env.syntax, env.sender) in ship_from_keys):
+            find_ship_from_segments(segments, env)
+        env.bytes_read = member.tell() if member.seekable() else 0
+    return env
+
+
+def find_ship_from_segments(segments, env):
+    # find_ship_from for a stream: reads on to the N1*SF / NAD+SF segment
+    for row in segments:
+        if env.syntax == X12:
+            if row[0] == "N1" and len(row) > 2 and row[1] == "SF":
+                env.ship_from_name = row[2]
+                if len(row) > 4:
+                    env.ship_from_code = row[4]
+                return
+        elif row[0][0] == "NAD" and len(row) > 1 and row[1][0] == "SF":
+            if len(row) > 2:
+                env.ship_from_code = row[2][0]
+            if len(row) > 4:
+                env.ship_from_name = row[4][0]
+            return
+
+
+def iter_bundle_members(f_path):
+    # Yields (member file name, function opening it as a binary stream)
+    if f_path.lower().endswith(".gz"):
+        yield os.path.basename(f_path)[:-len(".gz")], lambda: gzip.open(f_path)
         return
-
-    new_filename = "GASHELBY" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
+    with zipfile.ZipFile(f_path) as bundle:
+        for info in bundle.infolist():
+            if not info.is_dir():
+                yield os.path.basename(info.filename), lambda info=info: bundle.open(info)
 
 
-###############################################################################
-# Grupo-Antolin Shelby End
-###############################################################################
+def write_member(open_member, path):
+    # Decompresses a member to path plus PART_SUFFIX, reading it to the end
+    # so the archive checks its CRC. The partial file is removed on failure.
+    part_path = path + PART_SUFFIX
+    try:
+        with open_member() as member, open(part_path, "wb") as out:
+            shutil.copyfileobj(member, out, COPY_CHUNK)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return part_path
+
+
+def unpack_bundle(filename, metrics=None, dedupe=None, options=None):
+    # Writes each member of a bundle to IN under its new name, or under its
+    # own name when it isn't renamed, then removes the bundle. A member
+    # whose names are both taken in IN is unpacked to STAGING instead.
+    # Every member is decompressed to a temporary name first; if any of
+    # them can't be read, none are kept and the bundle stays in STAGING.
+    # With a DuplicateIndex, a member whose interchange has been seen goes
+    # to options.quarantine_dir, and those written to IN are added to it.
+    # Returns (new file name, envelope) for each member routed under its new
+    # name, for extraction and acknowledgement. The envelope, with its
+    # transaction sets listed, is only read when options.ack_dir is set.
+    # With options.dry_run, only prints where each member would go.
+    f_path = os.path.join(staging_dir, filename)
+    dry_run = options is not None and options.dry_run
+    routed = []
+    written = []  # (part path, path, renamed, member name, duplicate key)
+    targets = set()
+    seen = set()
+    keys = []
+    try:
+        for name, open_member in iter_bundle_members(f_path):
+            result = classify_file_detail(name, open_member)
+            if metrics:
+                metrics.files_scanned += 1
+                metrics.add(result)
+            key = result.interchange
+            if dedupe is not None and key and (key in seen or key in dedupe):
+                path = quarantine_path(name, options, targets)
+                targets.add(path)
+                if dry_run:
+                    print("Duplicate interchange " + key + ": " + f_path + ":" + name + '  >  ' + path)
+                    continue
+                written.append((write_member(open_member, path), path, False, name, key))
+                continue
+            seen.add(key)
+            paths = [in_path(result.new_filename)] if result.new_filename else []
+            paths += [os.path.join(in_dir, name), os.path.join(staging_dir, name)]
+            for path in paths:
+                if path not in targets and not os.path.exists(path):
+                    break
+            else:
+                raise FileExistsError(errno.EEXIST, "Member already in STAGING", name)
+            targets.add(path)
+            if key and path != paths[-1]:
+                # Members left in STAGING are checked when they are routed
+                keys.append(key)
+            if dry_run:
+                print(f_path + ":" + name + '  >  ' + path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = write_member(open_member, path)
+            renamed = result.new_filename if path == paths[0] else None
+            written.append((part_path, path, renamed, name, None))
+    except BaseException:
+        for part_path, _, _, _, _ in written:
+            os.remove(part_path)
+        raise
+    if dry_run:
+        return routed
+    for part_path, path, renamed, name, duplicate in written:
+        os.rename(part_path, path)
+        if duplicate:
+            print("Duplicate interchange " + duplicate + ": " + f_path + ":" + name + '  >  ' + path)
+            if metrics:
+                metrics.duplicates += 1
+            continue
+        if renamed:
+            link_flat_view(path)
+            env = None
+            if options and options.ack_dir:
+                env = read_envelope(path, (), True)
+            routed.append((renamed, env))
+        if metrics:
+            metrics.members_written += 1
+        print(f_path + ":" + name + '  >  ' + path)
+    os.remove(f_path)
+    if dedupe is not None:
+        dedupe.add(keys)
+    return routed
+
+
+def stage_bundle(filename, metrics=None):
+    # Unpacks each member of a bundle to STAGING under its own name, then
+    # removes the bundle. Returns the member names. As in unpack_bundle,
+    # nothing is kept unless every member can be read. A member already in
+    # STAGING with the same content, left by a run stopped part way, is
+    # taken as unpacked; any other file with its name stops the unpack.
+    f_path = os.path.join(staging_dir, filename)
+    written = []  # (part path, path, member name, already unpacked)
+    targets = set()
+    try:
+        for name, open_member in iter_bundle_members(f_path):
+            path = os.path.join(staging_dir, name)
+            if path in targets:
+                raise FileExistsError(errno.EEXIST, "Member name repeated in the bundle", name)
+            targets.add(path)
+            part_path = write_member(open_member, path)
+            written.append((part_path, path, name, False))
+            if os.path.exists(path):
+                if not filecmp.cmp(part_path, path, shallow=False):
+                    raise FileExistsError(errno.EEXIST, "Member already in STAGING", name)
+                written[-1] = (part_path, path, name, True)
+    except BaseException:
+        for part_path, _, _, _ in written:
+            os.remove(part_path)
+        raise
+    for part_path, path, name, already in written:
+        if already:
+            os.remove(part_path)
+        else:
+            os.rename(part_path, path)
+        if metrics:
+            metrics.members_written += 1
+        print(f_path + ":" + name + '  >  ' + path)
+    os.remove(f_path)
+    return [name for _, _, name, _ in written]
+
+
+def unpack_bundles(filenames, metrics=None, dedupe=None, options=None):
+    # unpack_bundle for each bundle, or stage_bundle with options.split or
+    # options.journal, whose members are returned with the other files.
+    # Returns the other files, plus any bundle that could not be read,
+    # which is then handled like any other file that isn't renamed, and
+    # the members routed from the bundles.
+    staged = options is not None and (options.split or options.journal) and not options.dry_run
+    remaining = []
+    routed = []
+    for filename in filenames:
+        if not is_bundle(filename):
+            remaining.append(filename)
+            continue
+        try:
+            if staged:
+                remaining += stage_bundle(filename, metrics)
+            else:
+                routed += unpack_bundle(filename, metrics, dedupe, options)
+        except (OSError, EOFError, zipfile.BadZipFile, zlib.error) as err:
+            print("Could not unpack " + filename + ": " + str(err))
+            remaining.append(filename)
+            continue
+        if metrics and not (options and options.dry_run):
+            metrics.bundles_unpacked += 1
+    return remaining, routed
+###############################################################################
+# Bundles End
+###############################################################################
+
+
+###############################################################################
+# Transaction Splitter Begin
+# Fans a file holding several interchanges, groups or transaction sets out
+# into one file per transaction set, each with a rebuilt envelope, so every
+# piece is named by the partner rules and can be loaded on its own.
+###############################################################################
+SPLIT_SUFFIX = "_%03d"  # Added to the staging name of each piece
+# Maps each byte to one character, so each segment of a piece keeps its
+# original bytes. Line breaks between segments are not copied to the pieces.
+SPLIT_ENCODING = "latin-1"
+
+
+def count_transactions(f_path, env, limit=None):
+    # Counts ST / UNH segments with a byte search of the mapped file,
+    # stopping at limit when one is given
+    term = re.escape(env.segment_term.encode(DEFAULT_ENCODING))
+    sep = re.escape(env.element_sep.encode(DEFAULT_ENCODING))
+    tag = b"ST" if env.syntax == X12 else b"UNH"
+    pattern = re.compile(term + rb"\s*" + tag + sep)
+    count = 0
+    with open(f_path, "rb") as edifile:
+        if os.fstat(edifile.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(edifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for match in pattern.finditer(mm):
+                count += 1
+                if limit and count >= limit:
+                    break
+    return count
+
+
+def split_x12(edifile, env, open_piece):
+    # Writes each ST..SE of an open X12 file to its own piece, between a
+    # copy of its ISA and GS and a rebuilt GE and IEA
+    sep, term = env.element_sep, env.segment_term
+    isa = gs = piece = None
+    for segment in read_segments(edifile, "", term):
+        tag = segment.split(sep, 1)[0]
+        if tag == "ISA":
+            isa = segment
+            gs = None
+        elif tag == "GS":
+            gs = segment
+        elif tag == "ST":
+            piece = open_piece()
+            piece.write(isa + term)
+            if gs:
+                piece.write(gs + term)
+            piece.write(segment + term)
+        elif tag == "SE":
+            piece.write(segment + term)
+            if gs:
+                piece.write(sep.join(["GE", "1", gs.split(sep)[6]]) + term)
+            piece.write(sep.join(["IEA", "1", isa.split(sep)[13]]) + term)
+            piece.close()
+            piece = None
+        elif tag in ("GE", "IEA"):
+            continue
+        elif piece:
+            piece.write(segment + term)
+        else:
+            raise ValueError("Segment outside a transaction set: " + tag)
+    if piece:
+        raise ValueError("Transaction set without an SE segment")
+
+
+def split_edifact(edifile, env, open_piece):
+    # Writes each UNH..UNT of an open EDIFACT file to its own piece, between
+    # a copy of its UNA, UNB and UNG and a rebuilt UNE and UNZ
+    sep, comp, term = env.element_sep, env.sub_element_sep, env.segment_term
+    data = edifile.read(UNA_SIZE)
+    una = ""
+    if data.startswith("UNA"):
+        una, data = data, ""
+    unb = ung = piece = None
+    for segment in read_segments_edifact(edifile, data, term, env.release_char):
+        tag = segment.split(sep, 1)[0]
+        if tag == "UNB":
+            unb = segment
+            ung = None
+        elif tag == "UNG":
+            ung = segment
+        elif tag == "UNH":
+            piece = open_piece()
+            piece.write(una + unb + term)
+            if ung:
+                piece.write(ung + term)
+            piece.write(segment + term)
+        elif tag == "UNT":
+            piece.write(segment + term)
+            if ung:
+                piece.write(sep.join(["UNE", "1", ung.split(sep)[5].split(comp)[0]]) + term)
+            piece.write(sep.join(["UNZ", "1", unb.split(sep)[5].split(comp)[0]]) + term)
+            piece.close()
+            piece = None
+        elif tag in ("UNE", "UNZ"):
+            continue
+        elif piece:
+            piece.write(segment + term)
+        else:
+            raise ValueError("Segment outside a message: " + tag)
+    if piece:
+        raise ValueError("Message without a UNT segment")
+
+
+def split_file(filename, envelopes=None):
+    # Splits a staging file holding more than one transaction set.
+    # Returns the names of the pieces, or [filename] when it isn't split.
+    # Segments are streamed, so memory use doesn't depend on file size.
+    # envelopes, when given, gets the envelope of a file that is split,
+    # with its transaction sets listed, under the name of each piece.
+    f_path = os.path.join(staging_dir, filename)
+    env = read_envelope(f_path, (), envelopes is not None)
+    if env.syntax is None:
+        return [filename]
+    count = count_transactions(f_path, env)
+    if count < 2:
+        return [filename]
+
+    base, ext = os.path.splitext(filename)
+    pieces = []
+
+    def open_piece():
+        # Pieces are written under a temporary name, so watch mode doesn't
+        # pick up a half written file
+        pieces.append(base + SPLIT_SUFFIX % (len(pieces) + 1) + ext)
+        return open(os.path.join(staging_dir, pieces[-1] + ".part"), "w", newline="",
+                    encoding=SPLIT_ENCODING)
 
+    try:
+        # newline="" keeps a CR segment terminator as it is
+        with open(f_path, newline="", encoding=SPLIT_ENCODING) as edifile:
+            if env.syntax == X12:
+                split_x12(edifile, env, open_piece)
+            else:
+                split_edifact(edifile, env, open_piece)
+        if len(pieces) != count:
+            # The original is only removed when every set is in a piece
+            raise ValueError("%d transaction sets but %d pieces" % (count, len(pieces)))
+    except Exception:
+        for piece in pieces:
+            try:
+                os.remove(os.path.join(staging_dir, piece + ".part"))
+            except OSError:
+                pass
+        raise
+    for piece in pieces:
+        os.replace(os.path.join(staging_dir, piece + ".part"), os.path.join(staging_dir, piece))
+    os.remove(f_path)
+    print(f_path + '  >  ' + str(len(pieces)) + " transaction sets")
+    if envelopes is not None:
+        envelopes.update(dict.fromkeys(pieces, env))
+    return pieces
+
+
+def split_staging_files(filenames, metrics=None, envelopes=None):
+    # split_file for each file. A file that can't be split is left whole.
+    split = []
+    for filename in filenames:
+        try:
+            pieces = split_file(filename, envelopes)
+        except Exception as err:
+            print("Could not split " + filename + ": " + str(err))
+            pieces = [filename]
+        if metrics and len(pieces) > 1:
+            metrics.files_split += 1
+            metrics.pieces_written += len(pieces)
+        split.extend(pieces)
+    return split
+###############################################################################
+# Transaction Splitter End
+###############################################################################
+
+
+###############################################################################
+# Classification Cache Begin
+# Remembers the new name worked out for each staging file, so files left
+# behind by an interrupted run are not read again.
+###############################################################################
+CACHE_COMMIT_EVERY = 500  # Results stored between commits
+
+
+class ClassificationCache:
+    # SQLite cache of classify_file results, keyed by path and file identity.
+    # An entry is only used while the file's size, mtime and inode match,
+    # and the whole cache is dropped when the partners file changes.
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS classification ("
+                        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                        "inode INTEGER, new_filename TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+        self.check_partners()
+
+    def check_partners(self):
+        # Drops every entry if the partner tables have changed
+        stamp = repr(PARTNERS_STAMP)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'partners'").fetchone()
+        if row and row[0] == stamp:
+            return
+        self.db.execute("DELETE FROM classification")
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('partners', ?)", (stamp,))
+        self.db.commit()
+
+    def identity(self, f_path):
+        try:
+            stat = os.stat(f_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def known_identity(self, f_path, identities):
+        # The identity from the directory scan, or from os.stat
+        if identities:
+            identity = identities.get(os.path.basename(f_path))
+            if identity is not None:
+                return identity
+        return self.identity(f_path)
+
+    def lookup(self, f_paths, new_filenames, identities=None):
+        # Fills new_filenames from the cache.
+        # Returns the indexes of the files that still need classifying.
+        self.check_partners()
+        todo = []
+        for idx, f_path in enumerate(f_paths):
+            row = self.db.execute("SELECT size, mtime_ns, inode, new_filename "
+                                  "FROM classification WHERE path = ?", (f_path,)).fetchone()
+            if row and row[:3] == self.known_identity(f_path, identities):
+                new_filenames[idx] = row[3]
+            else:
+                todo.append(idx)
+        return todo
+
+    def store(self, f_paths, new_filenames, identities=None):
+        for count, (f_path, new_filename) in enumerate(zip(f_paths, new_filenames), 1):
+            identity = self.known_identity(f_path, identities)
+            if identity is None:
+                continue
+            self.db.execute("INSERT OR REPLACE INTO classification VALUES (?, ?, ?, ?, ?)",
+                            (f_path,) + identity + (new_filename,))
+            if count % CACHE_COMMIT_EVERY == 0:
+                self.db.commit()
+        self.db.commit()
+
+    def discard(self, f_paths):
+        # Drops the entries for files that are no longer in STAGING
+        gone = [(f_path,) for f_path in f_paths if not os.path.exists(f_path)]
+        self.db.executemany("DELETE FROM classification WHERE path = ?", gone)
+        self.db.commit()
+
+    def prune(self, f_paths):
+        # Drops every entry not in f_paths
+        self.start_prune()
+        self.mark_present(f_paths)
+        self.finish_prune()
+
+    def start_prune(self):
+        # prune in steps, for a directory read a chunk at a time
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS present (path TEXT PRIMARY KEY)")
+        self.db.execute("DELETE FROM present")
+
+    def mark_present(self, f_paths):
+        self.db.executemany("INSERT OR IGNORE INTO present VALUES (?)",
+                            [(f_path,) for f_path in f_paths])
+
+    def finish_prune(self):
+        # Drops every entry not marked present since start_prune
+        self.db.execute("DELETE FROM classification WHERE path NOT IN (SELECT path FROM present)")
+        self.db.execute("DELETE FROM present")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+###############################################################################
+# Classification Cache End
+###############################################################################
+
+
+###############################################################################
+# Duplicate Index Begin
+# The VAN re-sends interchanges after timeouts. Each interchange routed is
+# recorded by sender and control number, and a copy that turns up again is
+# quarantined instead of reaching the ERP importer.
+###############################################################################
+BLOOM_CAPACITY = 1000000  # Interchanges before the filter is rebuilt larger
+BLOOM_BITS_PER_KEY = 10   # About 1% false positives with 7 hashes
+BLOOM_HASHES = 7
+
+
+def interchange_key(env):
+    # Sender, interchange control number (ISA13 / UNB 0020) and the first
+    # transaction set control number. Split pieces share the interchange
+    # control number, so the set number tells them apart.
+    if env.syntax is None or env.control_number is None:
+        return None
+    return "|".join((env.syntax, env.sender or "", env.control_number, env.doc_control or ""))
+
+
+class BloomFilter:
+    # Bit array answering "maybe seen" or "never seen" without the database
+
+    def __init__(self, capacity, bits=None):
+        self.capacity = capacity
+        self.size = capacity * BLOOM_BITS_PER_KEY
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.size for i in range(BLOOM_HASHES)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+
+class DuplicateIndex:
+    # SQLite table of the interchanges already routed, behind a Bloom
+    # filter so that a new interchange, the usual case, costs no query.
+    # The filter is saved with the row count it covers and rebuilt from
+    # the table when that doesn't match, after a crash for instance.
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS interchange ("
+                        "key TEXT PRIMARY KEY, seen REAL) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM interchange").fetchone()[0]
+        self.bloom = self.load_bloom()
+
+    def load_bloom(self):
+        rows = dict(self.db.execute("SELECT key, value FROM meta WHERE key LIKE 'bloom_%'"))
+        if rows.get("bloom_count") == self.count and rows.get("bloom_bits") is not None:
+            return BloomFilter(rows["bloom_capacity"], bytearray(rows["bloom_bits"]))
+        capacity = BLOOM_CAPACITY
+        while capacity < self.count * 2:
+            capacity *= 2
+        bloom = BloomFilter(capacity)
+        for (key,) in self.db.execute("SELECT key FROM interchange"):
+            bloom.add(key)
+        return bloom
+
+    def __contains__(self, key):
+        if key not in self.bloom:
+            return False
+        return self.db.execute("SELECT 1 FROM interchange WHERE key = ?",
+                               (key,)).fetchone() is not None
+
+    def add(self, keys):
+        now = time.time()
+        for key in keys:
+            if key in self.bloom and key in self:
+                continue
+            self.db.execute("INSERT INTO interchange VALUES (?, ?)", (key, now))
+            self.bloom.add(key)
+            self.count += 1
+        self.db.commit()
+        if self.count > self.bloom.capacity:
+            self.bloom = self.load_bloom()
+
+    def close(self):
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", (
+            ("bloom_capacity", self.bloom.capacity),
+            ("bloom_count", self.count),
+            ("bloom_bits", bytes(self.bloom.bits)),
+        ))
+        self.db.commit()
+        self.db.close()
+
+
+def quarantine_path(filename, options, taken=()):
+    # A free name for filename in options.quarantine_dir, and not in taken.
+    # Repeats of the same file get .2, .3 and so on.
+    os.makedirs(options.quarantine_dir, exist_ok=True)
+    target = os.path.join(options.quarantine_dir, filename)
+    count = 1
+    while target in taken or os.path.exists(target):
+        count += 1
+        target = os.path.join(options.quarantine_dir, "%s.%d" % (filename, count))
+    return target
+
+
+def quarantine_duplicates(dedupe, filenames, new_filenames, keys, classified, options,
+                          metrics=None):
+    # Moves the files whose interchange is already in the index, or earlier
+    # in this batch, to options.quarantine_dir. classified holds the indexes
+    # with a key from classify_file_detail; the others came from the cache
+    # and have their envelope read again. Returns the rest of the batch.
+    kept = ([], [], [])
+    seen = set()
+    # The first copy in file name order is the one kept
+    for idx in sorted(range(len(filenames)), key=filenames.__getitem__):
+        filename, new_filename, key = filenames[idx], new_filenames[idx], keys[idx]
+        if idx not in classified:
+            try:
+                key = interchange_key(read_envelope(os.path.join(staging_dir, filename), ()))
+            except Exception:
+                key = None
+        if key is None or (key not in seen and key not in dedupe):
+            seen.add(key)
+            for column, value in zip(kept, (filename, new_filename, key)):
+                column.append(value)
+            continue
+        old_filename = os.path.join(staging_dir, filename)
+        target = quarantine_path(filename, options)
+        move_file(old_filename, target)
+        print("Duplicate interchange " + key + ": " + old_filename + '  >  ' + target)
+        if metrics:
+            metrics.duplicates += 1
+    return kept
 ###############################################################################
-# Grupo-Antolin Alabama (EDIFACT) Begin
+# Duplicate Index End
 ###############################################################################
-def rename_file_gaalabama(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
 
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
 
-
-    isa = get_isa_edifact(f_path)
-    if isa != ga_alabama_isa:
-        return
-
-    new_filename = "GAALABAMA" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-# Grupo-Antolin Alabama End
 ###############################################################################
-
-###############################################################################
-# Grupo-Antolin TN/KY (EDIFACT) Begin
+# Acknowledgements Begin
+# Functional acknowledgements (X12 997/999, EDIFACT CONTRL) for the files
+# routed in a batch, built from the envelopes read while classifying, or
+# before splitting for a split file. Each partner gets one interchange per
+# batch in the acknowledgement directory.
 ###############################################################################
-def rename_file_gatn(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
+ACK_CONTROL_FILE = "ack_control.json"  # Last interchange control number used
 
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
 
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
-
-
-    isa = get_isa_edifact(f_path)
-    if isa != ga_tn_isa:
+def next_ack_control(directory):
+    # The next outbound interchange control number, kept in directory
+    path = os.path.join(directory, ACK_CONTROL_FILE)
+    try:
+        with open(path, encoding="utf-8") as control_file:
+            number = json.load(control_file)["control"] + 1
+    except FileNotFoundError:
+        number = 1
+    if number > 999999999:
+        number = 1
+    with open(path + ".tmp", "w", encoding="utf-8") as control_file:
+        json.dump({"control": number}, control_file)
+    os.replace(path + ".tmp", path)
+    return number
+
+
+def ack_type(env, partner):
+    if partner.ack is not True:
+        return partner.ack
+    if env.syntax == EDIFACT:
+        return "CONTRL"
+    # 005010 implementation guides ask for a 999
+    version = env.group_header[8] if env.group_header and len(env.group_header) > 8 else ""
+    return "999" if version.startswith("005010X") else "997"
+
+
+def build_ack_x12(envelopes, kind, control, now):
+    # One interchange acknowledging every group of the envelopes, which
+    # all come from one partner
+    first = envelopes[0]
+    isa = first.interchange_header
+    sep, term = first.element_sep, first.segment_term
+    segments = [
+        ["ISA", isa[1], isa[2], isa[3], isa[4], isa[7], isa[8], isa[5], isa[6],
+         time.strftime("%y%m%d", now), time.strftime("%H%M", now), isa[11], isa[12],
+         "%09d" % control, "0", isa[15], first.sub_element_sep],
+        ["GS", "FA", first.group_header[3], first.group_header[2], time.strftime("%Y%m%d", now),
+         time.strftime("%H%M", now), str(control), "X", first.group_header[8]],
+    ]
+    set_count = 0
+    for env in envelopes:
+        for gs, sets in env.groups:
+            set_count += 1
+            st = ["ST", kind, "%04d" % set_count]
+            if kind == "999":
+                st.append(gs[8])
+            body = [st, ["AK1", gs[1], gs[6]] + ([gs[8]] if kind == "999" else [])]
+            for row in sets:
+                if kind == "999":
+                    body += [["AK2", row[1], row[2]] + ([row[3]] if len(row) > 3 else []),
+                             ["IK5", "A"]]
+                else:
+                    body += [["AK2", row[1], row[2]], ["AK5", "A"]]
+            count = str(len(sets))
+            body.append(["AK9", "A", count, count, count])
+            body.append(["SE", str(len(body) + 1), "%04d" % set_count])
+            segments += body
+    segments.append(["GE", str(set_count), str(control)])
+    segments.append(["IEA", "1", "%09d" % control])
+    return "".join(sep.join(row) + term for row in segments), set_count
+
+
+def build_ack_edifact(envelopes, control, now):
+    # One interchange with a CONTRL message for each envelope
+    first = envelopes[0]
+    sep, comp, term = first.element_sep, first.sub_element_sep, first.segment_term
+    release = first.release_char or " "
+    unb = first.interchange_header
+
+    def segment(*elements):
+        return sep.join(comp.join(element) if isinstance(element, list) else element
+                        for element in elements) + term
+
+    text = "UNA" + comp + sep + "." + release + " " + term
+    text += segment("UNB", unb[1], unb[3], unb[2],
+                    [time.strftime("%y%m%d", now), time.strftime("%H%M", now)], str(control))
+    for number, env in enumerate(envelopes, 1):
+        header = env.interchange_header
+        body = [segment("UNH", str(number), ["CONTRL", "D", "3", "UN"]),
+                segment("UCI", header[5][0], header[2], header[3], "7")]
+        for _, sets in env.groups:
+            for line in sets:
+                body.append(segment("UCM", line[1][0], line[2][:4], "7"))
+        body.append(segment("UNT", str(len(body) + 1), str(number)))
+        text += "".join(body)
+    text += segment("UNZ", str(len(envelopes)), str(control))
+    return text, len(envelopes)
+
+
+def write_acks(envelopes, options, metrics=None):
+    # Writes the acknowledgements for the envelopes of the routed files,
+    # one file per partner, through a temporary name
+    by_partner = {}
+    for env in envelopes:
+        partner = ROUTES.get((env.syntax, env.sender))
+        if partner is None or not partner.ack or not env.groups or env.interchange_header is None:
+            continue
+        if env.syntax == X12 and env.group_header is None:
+            continue
+        kind = ack_type(env, partner)
+        by_partner.setdefault((partner.tag, kind), []).append(env)
+    if not by_partner:
         return
+    os.makedirs(options.ack_dir, exist_ok=True)
+    now = time.localtime()
+    for (tag, kind), group in sorted(by_partner.items()):
+        control = next_ack_control(options.ack_dir)
+        if kind == "CONTRL":
+            text, count = build_ack_edifact(group, control, now)
+        else:
+            text, count = build_ack_x12(group, kind, control, now)
+        path = os.path.join(options.ack_dir, "%s-%s-%s-%09d.edi" % (
+            tag, kind, time.strftime("%Y%m%d%H%M%S", now), control))
+        with open(path + PART_SUFFIX, "w", newline="", encoding=group[0].encoding,
+                  errors="replace") as ack_file:
+            ack_file.write(text)
+        os.replace(path + PART_SUFFIX, path)
+        print("Acknowledged " + str(len(group)) + " interchanges  >  " + path)
+        if metrics:
+            metrics.acks_written += count
+###############################################################################
+# Acknowledgements End
+###############################################################################
+
+
+###############################################################################
+# Service Begin
+# A long running process answering classify and route requests from the
+# AS2/SFTP receivers, on localhost HTTP or a Unix domain socket, with the
+# partner tables loaded and recent answers cached.
+#   POST /classify {"path": ...}  or  {"op": "classify", "path": ...}\n
+#   POST /route {"path": ...}     or  {"op": "route", "path": ...}\n
+###############################################################################
+SERVICE_CACHE_SIZE = 10000  # Classifications kept in memory
+
+
+class ClassifyService:
+    # Thread safe classify and route, shared by both transports
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = {}  # (path, size, mtime_ns, inode) > Classification
+
+    def classify(self, f_path):
+        with self.lock:
+            if reload_partners():
+                self.cache.clear()
+        stat = os.stat(f_path)
+        key = (f_path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        result = self.cache.get(key)
+        if result is None:
+            result = classify_file_detail(f_path)
+            with self.lock:
+                if len(self.cache) >= SERVICE_CACHE_SIZE:
+                    # Drop the oldest entry
+                    del self.cache[next(iter(self.cache))]
+                self.cache[key] = result
+        return result
+
+    def handle(self, op, f_path):
+        # Returns the answer for one request as a dict. classify reads any
+        # file; route only moves files in STAGING.
+        start = time.perf_counter()
+        if op not in ("classify", "route"):
+            raise ValueError("Unknown op " + repr(op))
+        f_path = os.path.abspath(f_path)
+        result = self.classify(f_path)
+        answer = {
+            "path": f_path,
+            "tag": result.tag,
+            "doc_type": result.doc_type,
+            "new_filename": result.new_filename,
+            "reason": result.reason,
+        }
+        if op == "route":
+            if os.path.dirname(os.path.realpath(f_path)) != os.path.realpath(staging_dir):
+                raise ValueError("route only moves files in " + staging_dir)
+            answer["routed"] = False
+            if result.new_filename:
+                target = in_path(result.new_filename)
+                with self.lock:
+                    if os.path.exists(target):
+                        answer["reason"] = "target_exists"
+                    else:
+                        move_file(f_path, target)
+                        link_flat_view(target)
+                        answer["routed"] = True
+                        answer["target"] = target
+        answer["seconds"] = time.perf_counter() - start
+        return answer
+
+    def answer(self, request):
+        # The JSON reply to a decoded request, with any error in it
+        if not isinstance(request, dict):
+            return {"error": "request must be a JSON object"}
+        try:
+            return self.handle(request.get("op", "classify"), request["path"])
+        except (KeyError, TypeError):
+            return {"error": "request needs a path"}
+        except (OSError, ValueError) as err:
+            return {"error": str(err)}
+
+
+class ServiceHTTPHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/health":
+            self.reply(200, {"partners": len(ROUTES)})
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        query["op"] = url.path.strip("/")
+        self.reply_to(query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.reply(400, {"error": "body must be JSON"})
+            return
+        if isinstance(request, dict):
+            request.setdefault("op", urllib.parse.urlsplit(self.path).path.strip("/"))
+        self.reply_to(request)
+
+    def reply_to(self, request):
+        answer = self.service.answer(request)
+        self.reply(400 if "error" in answer else 200, answer)
+
+    def reply(self, status, answer):
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request is too much at receiver rates
+        pass
+
+
+class ServiceSocketHandler(socketserver.StreamRequestHandler):
+    # One JSON request per line, one JSON answer per line
+    service = None
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                answer = self.service.answer(json.loads(line))
+            except ValueError:
+                answer = {"error": "request must be JSON"}
+            self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+            self.wfile.flush()
 
-    new_filename = "GATN" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-# Grupo-Antolin TN/KY End
-###############################################################################
-
-###############################################################################
-# Grupo-Antolin Silao (EDIFACT) Begin
-###############################################################################
-def rename_file_gasilao(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
-
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
 
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
+def is_loopback(host):
+    # True for localhost and loopback addresses, IPv6 ones in brackets too
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
 
 
-    isa = get_isa_edifact(f_path)
-    if isa != ga_silao_isa:
+def remove_socket(address):
+    # Removes a Unix domain socket left at address. Anything else there is
+    # kept, and raises FileExistsError.
+    try:
+        mode = os.lstat(address).st_mode
+    except FileNotFoundError:
         return
-
-    new_filename = "GASILAO" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-# Grupo-Antolin Silao End
-###############################################################################
-
+    if not S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket", address)
+    os.remove(address)
+
+
+def make_server(address, service=None):
+    # HOST:PORT serves HTTP on that address; anything else is the path of
+    # a Unix domain socket. Requests aren't authenticated, and route moves
+    # files, so HTTP is only served on a loopback address.
+    service = service or ClassifyService()
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit():
+        if not is_loopback(host):
+            raise ValueError("Serving on " + host + " would expose route; use localhost")
+        host = host.strip("[]")
+        handler = type("Handler", (ServiceHTTPHandler,), {"service": service})
+        server_class = ThreadingHTTPServer
+        if ":" in host:
+            server_class = type("Server", (ThreadingHTTPServer,), {"address_family": socket.AF_INET6})
+        return server_class((host, int(port)), handler)
+    remove_socket(address)
+    handler = type("Handler", (ServiceSocketHandler,), {"service": service})
+    server = socketserver.ThreadingUnixStreamServer(address, handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(address):
+    server = make_server(address)
+    print("\nServing classify and route requests on " + address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped serving " + address)
+    finally:
+        server.server_close()
+        if not isinstance(server, ThreadingHTTPServer):
+            remove_socket(address)
+###############################################################################
+# Service End
+###############################################################################
+
+
+###############################################################################
+# Run Metrics Begin
+# Counters and timings for each staging run, written as JSON and as a
+# Prometheus textfile for the node exporter's textfile collector.
+###############################################################################
+METRICS_NAME = "edi_inbound_rename"  # File name for the .json and .prom files
+READ_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    # Cumulative histogram with fixed upper bounds, in seconds
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+
+    def as_dict(self):
+        return {"buckets": dict(zip(map(str, self.buckets), self.counts)),
+                "count": self.count, "sum": self.sum}
+
+
+class RunMetrics:
+    # Metrics for one batch run, or for the life of a watch mode process
+
+    def __init__(self):
+        self.started = time.time()
+        self.run_seconds = 0.0
+        self.files_scanned = 0
+        self.cache_hits = 0
+        self.files_matched = {}  # Partner tag > files renamed
+        self.files_unmatched = {}  # Reason > files without a new name
+        self.parse_failures = {}  # Exception type > files
+        self.files_remaining = 0  # Files moved by move_remaining_files
+        self.files_split = 0  # Files split into one file per transaction set
+        self.pieces_written = 0  # Files written by the splitter
+        self.bundles_unpacked = 0  # .zip and .gz bundles read
+        self.members_written = 0  # Files written from bundles
+        self.lines_extracted = 0  # Forecast and schedule lines extracted
+        self.duplicates = 0  # Interchanges quarantined as duplicates
+        self.acks_written = 0  # Acknowledgement transaction sets / messages
+        self.bytes_read = 0
+        self.stage_seconds = {"list": 0.0, "read": 0.0, "route": 0.0, "rename": 0.0,
+                              "extract": 0.0}
+        self.read_latency = Histogram(READ_BUCKETS)
+
+    def add(self, result):
+        # Records one Classification
+        if result.new_filename:
+            self.files_matched[result.tag] = self.files_matched.get(result.tag, 0) + 1
+        else:
+            self.files_unmatched[result.reason] = self.files_unmatched.get(result.reason, 0) + 1
+        if result.cause:
+            self.parse_failures[result.cause] = self.parse_failures.get(result.cause, 0) + 1
+        self.bytes_read += result.bytes_read
+        self.stage_seconds["read"] += result.read_seconds
+        self.stage_seconds["route"] += result.route_seconds
+        self.read_latency.observe(result.read_seconds)
+
+    def add_cached(self, new_filename):
+        # Records a file classified from the cache
+        self.cache_hits += 1
+        if new_filename:
+            tag = new_filename.split("-")[0]
+            self.files_matched[tag] = self.files_matched.get(tag, 0) + 1
+        else:
+            self.files_unmatched["cached"] = self.files_unmatched.get("cached", 0) + 1
+
+    def as_dict(self):
+        return {
+            "started": self.started,
+            "run_seconds": self.run_seconds,
+            "files_scanned": self.files_scanned,
+            "cache_hits": self.cache_hits,
+            "files_matched": self.files_matched,
+            "files_unmatched": self.files_unmatched,
+            "parse_failures": self.parse_failures,
+            "files_remaining": self.files_remaining,
+            "files_split": self.files_split,
+            "pieces_written": self.pieces_written,
+            "bundles_unpacked": self.bundles_unpacked,
+            "members_written": self.members_written,
+            "lines_extracted": self.lines_extracted,
+            "duplicates": self.duplicates,
+            "acks_written": self.acks_written,
+            "bytes_read": self.bytes_read,
+            "stage_seconds": self.stage_seconds,
+            "read_latency_seconds": self.read_latency.as_dict(),
+        }
+
+    def as_prometheus(self):
+        prefix = "edi_staging_"
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP " + prefix + name + " " + help_text)
+            lines.append("# TYPE " + prefix + name + " " + kind)
+            for labels, value in samples:
+                lines.append(prefix + name + labels + " " + repr(value))
+
+        def labelled(label, values):
+            return [('{%s="%s"}' % (label, key), value) for key, value in sorted(values.items())]
+
+        metric("last_run_timestamp_seconds", "gauge", "Start of the run.", [("", self.started)])
+        metric("run_seconds", "gauge", "Wall time of the run.", [("", self.run_seconds)])
+        metric("files_scanned_total", "counter", "Files found in STAGING.",
+               [("", self.files_scanned)])
+        metric("cache_hits_total", "counter", "Files classified from the cache.",
+               [("", self.cache_hits)])
+        metric("files_matched_total", "counter", "Files renamed for a partner.",
+               labelled("partner", self.files_matched))
+        metric("files_unmatched_total", "counter", "Files without a new name.",
+               labelled("reason", self.files_unmatched))
+        metric("parse_failures_total", "counter", "Files that could not be parsed.",
+               labelled("cause", self.parse_failures))
+        metric("files_remaining_total", "counter", "Files moved by move_remaining_files.",
+               [("", self.files_remaining)])
+        metric("files_split_total", "counter", "Files split by transaction set.",
+               [("", self.files_split)])
+        metric("pieces_written_total", "counter", "Files written by the splitter.",
+               [("", self.pieces_written)])
+        metric("bundles_unpacked_total", "counter", "Bundles read from STAGING.",
+               [("", self.bundles_unpacked)])
+        metric("members_written_total", "counter", "Files written from bundles.",
+               [("", self.members_written)])
+        metric("lines_extracted_total", "counter", "Forecast and schedule lines extracted.",
+               [("", self.lines_extracted)])
+        metric("duplicates_total", "counter", "Interchanges quarantined as duplicates.",
+               [("", self.duplicates)])
+        metric("acks_written_total", "counter", "Acknowledgements written.",
+               [("", self.acks_written)])
+        metric("bytes_read_total", "counter", "Bytes read or searched.", [("", self.bytes_read)])
+        metric("stage_seconds_total", "counter", "Time spent in each stage.",
+               labelled("stage", self.stage_seconds))
+        name = "file_read_seconds"
+        lines.append("# HELP " + prefix + name + " Time to open and read one envelope.")
+        lines.append("# TYPE " + prefix + name + " histogram")
+        for bound, count in zip(self.read_latency.buckets, self.read_latency.counts):
+            lines.append(prefix + name + '_bucket{le="' + repr(bound) + '"} ' + str(count))
+        lines.append(prefix + name + '_bucket{le="+Inf"} ' + str(self.read_latency.count))
+        lines.append(prefix + name + "_sum " + repr(self.read_latency.sum))
+        lines.append(prefix + name + "_count " + str(self.read_latency.count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        # Writes both files through a temporary name, so a scraper never
+        # sees a partial file
+        os.makedirs(directory, exist_ok=True)
+        outputs = (
+            (".json", json.dumps(self.as_dict(), indent=2, sort_keys=True)),
+            (".prom", self.as_prometheus()),
+        )
+        for ext, text in outputs:
+            path = os.path.join(directory, METRICS_NAME + ext)
+            with open(path + ".tmp", "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(text)
+            os.replace(path + ".tmp", path)
+###############################################################################
+# Run Metrics End
+###############################################################################
+
+
+###############################################################################
+# Watch Mode Begin
+# Keeps running and routes files as they land in STAGING.
+###############################################################################
+WATCH_INTERVAL = 5  # Seconds between polls of STAGING
+
+
+class Inotify:
+    # Linux inotify watch on a directory, through ctypes.
+    # Reports files once their writer has closed them or they are moved in.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_SIZE = struct.calcsize("iIII")
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed", path)
+
+    def wait(self, timeout):
+        # Returns the names reported within timeout seconds
+        names = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return names
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            pos += self.EVENT_SIZE
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(path):
+    # inotify where the platform has it, otherwise None (polling only)
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return Inotify(path)
+    except (OSError, AttributeError):
+        return None
+
+
+def scan_staging_dir(pending, skip):
+    # Polls STAGING with os.scandir, using the stat data of each DirEntry.
+    # pending maps new file names to their (size, mtime) at the last poll.
+    # Returns the files that haven't changed since then; a file still
+    # being written shows a new size or mtime and waits for the next poll.
+    ready = []
+    seen = {}
+    with os.scandir(staging_dir) as entries:
+        for entry in entries:
+            if entry.name in skip or entry.name.endswith(PART_SUFFIX):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Gone since the listing, routed by the service for instance
+                continue
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            if pending.get(entry.name) == stamp:
+                ready.append(entry.name)
+            else:
+                seen[entry.name] = stamp
+    pending.clear()
+    pending.update(seen)
+    return ready
+
+
+def timed_scan(pending, skip, metrics=None):
+    # scan_staging_dir, adding its time to the list stage
+    start = time.perf_counter()
+    ready = scan_staging_dir(pending, skip)
+    if metrics:
+        metrics.stage_seconds["list"] += time.perf_counter() - start
+    return ready
+
+
+def watch_staging_dir(options=None):
+    # Routes files within seconds of arrival until interrupted.
+    # Files that can't be moved out of STAGING are not tried again.
+    # With a watcher, STAGING is still scanned every interval, for the
+    # files there at startup and any whose events were lost.
+    # Metrics are totals since the watch started, written after each batch.
+    options = options or Options()
+    interval = options.interval
+    print("\nWatching " + staging_dir)
+    if options.journal:
+        recover_journal(options.journal, options.recover, options.dry_run)
+    metrics = RunMetrics() if options.metrics_dir else None
+    cache = ClassificationCache(options.cache_file) if options.cache_file else None
+    dedupe = DuplicateIndex(options.dedupe_file) if options.dedupe_file else None
+    executor = make_executor(options.workers, options.pool)
+    watcher = open_watcher(staging_dir)
+    pending = {}
+    stuck = set()
+    last_scan = None
+    try:
+        while True:
+            if reload_partners() and options.pool == "process" and executor:
+                # Worker processes hold their own copy of the tables
+                executor.shutdown()
+                executor = make_executor(options.workers, options.pool)
+            if watcher:
+                ready = [name for name in watcher.wait(interval) if name not in stuck]
+                if last_scan is None or time.monotonic() - last_scan >= interval:
+                    # Catch anything the watch missed, however busy it is
+                    ready += timed_scan(pending, stuck, metrics)
+                    last_scan = time.monotonic()
+            else:
+                ready = timed_scan(pending, stuck, metrics)
+                if not ready:
+                    time.sleep(interval)
+            ready = [name for name in dict.fromkeys(ready)
+                     if os.path.isfile(os.path.join(staging_dir, name))]
+            if not ready:
+                continue
+            process_files(ready, executor, cache, metrics, options, dedupe=dedupe)
+            for name in ready:
+                pending.pop(name, None)
+                if os.path.exists(os.path.join(staging_dir, name)):
+                    stuck.add(name)
+            if metrics:
+                metrics.run_seconds = time.time() - metrics.started
+                metrics.write(options.metrics_dir)
+    except KeyboardInterrupt:
+        print("\nStopped watching " + staging_dir)
+    finally:
+        if watcher:
+            watcher.close()
+        if executor:
+            executor.shutdown()
+        if cache:
+            cache.close()
+        if dedupe:
+            dedupe.close()
 ###############################################################################
-# Grupo-Antolin St. Clair (EDIFACT) Begin
+# Watch Mode End
 ###############################################################################
-def rename_file_gastclair(filename):
-    f = filename  # Raw file name
-    f_path = os.path.join(staging_dir, filename)  # file name with path
 
-    # Check if in ECGrid format.
-    # ECGrid file format: 1027-20201006101520-2e7441af.edi
-    if not f.startswith("1027"):
-        # Not an ECGrid file
-        return
 
-    sep = "-" # File separator
-    f_ext = ".edi"  # File extension
-    f = os.path.splitext(f)[0]  # Strip extension
-    f_list = f.split(sep)  # Make a list from the split    
-    f_date = f_list[1]  # The second piece is the date code
-    f_idx = f_list[2]  # The third piece is the index
-    f_type = get_file_type_edifact(f_path)
-
-
-    isa = get_isa_edifact(f_path)
-    if isa != ga_stclair_isa:
-        return
-
-    new_filename = "GASTCLAIR" + sep + f_type + sep + f_date + sep + f_idx + f_ext
-    old_filename = os.path.join(staging_dir, filename)
-    new_filename = os.path.join(in_dir, new_filename)
-    os.rename(old_filename, new_filename)
-    print(old_filename + '  >  ' + new_filename)
-
-
-###############################################################################
-# Grupo-Antolin St. Clair End
-###############################################################################
+reload_partners()
 
 
 if __name__ == '__main__':
-    process_staging_dir()
+    parser = argparse.ArgumentParser(description="Rename EDI files in STAGING and move them to IN")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="classify files with this many workers (default: serial)")
+    parser.add_argument("--pool", choices=("thread", "process"), default="thread",
+                        help="worker pool type (default: thread)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and route files as they arrive")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                        help="seconds between polls in watch mode (default: %(default)s)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="SQLite file that keeps classifications between runs")
+    parser.add_argument("--metrics", metavar="DIR",
+                        help="write run metrics to DIR as JSON and a Prometheus textfile")
+    parser.add_argument("--split", action="store_true",
+                        help="split files holding more than one transaction set")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="plan each batch, then apply it through this journal file")
+    parser.add_argument("--recover", choices=("replay", "rollback"), default="replay",
+                        help="what to do with an unfinished journal (default: replay)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the rename plan without renaming anything")
+    parser.add_argument("--move-workers", type=int, default=0, metavar="N",
+                        help="moves to run at once when IN is on another volume")
+    parser.add_argument("--layout", choices=IN_LAYOUTS, default="flat",
+                        help="put renamed files straight in IN, or in IN\\TAG\\TYPE\\DATE")
+    parser.add_argument("--flat-view", action="store_true",
+                        help="with --layout sharded, also link each file into IN")
+    parser.add_argument("--migrate", action="store_true",
+                        help="move the files already in IN to --layout, then exit")
+    parser.add_argument("--chunk-size", type=int, default=STAGING_CHUNK, metavar="N",
+                        help="files read from STAGING per batch, 0 for all (default: %(default)s)")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="record progress so a stopped run can resume")
+    parser.add_argument("--extract", metavar="DIR",
+                        help="write 830/862 and DELFOR/DELJIT lines of renamed files to DIR")
+    parser.add_argument("--extract-format", choices=("csv", "npy"), default="csv",
+                        help="extract batch format; npy needs NumPy (default: csv)")
+    parser.add_argument("--dedupe", metavar="FILE",
+                        help="SQLite index of routed interchanges; quarantine repeats")
+    parser.add_argument("--quarantine", metavar="DIR",
+                        help="where duplicate interchanges go (default: M:\\EDI\\QUARANTINE)")
+    parser.add_argument("--acks", metavar="DIR",
+                        help="write 997/999 and CONTRL acknowledgements for routed files to DIR")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="answer classify/route requests on a loopback HOST:PORT (HTTP) "
+                             "or a Unix socket path")
+    args = parser.parse_args()
+    if args.extract_format == "npy":
+        import edi_extract
+        if edi_extract.numpy is None:
+            parser.error("--extract-format npy needs NumPy; use csv")
+    in_layout = args.layout
+    in_flat_view = args.flat_view
+    options = Options(workers=args.workers, pool=args.pool, cache_file=args.cache,
+                      metrics_dir=args.metrics, split=args.split, interval=args.interval,
+                      journal=args.journal, recover=args.recover, dry_run=args.dry_run,
+                      move_workers=args.move_workers, chunk_size=args.chunk_size,
+                      checkpoint=args.checkpoint, extract_dir=args.extract,
+                      extract_format=args.extract_format, dedupe_file=args.dedupe,
+                      ack_dir=args.acks)
+    if args.quarantine:
+        options.quarantine_dir = args.quarantine
+    if args.serve:
+        serve(args.serve)
+    elif args.migrate:
+        migrate_in_dir(args.layout)
+    elif args.watch:
+        watch_staging_dir(options)
+    else:
+        process_staging_dir(options)
@@ -0,0 +1,93 @@
+import os
+import time
+import zipfile
+
+import edi_inbound_rename as edi
+
+from test_bundles import make_dirs
+from test_ship_from import isa
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+NOW = time.struct_time((2020, 10, 6, 10, 15, 20, 1, 280, 0))
+
+# Two 830s in one group, and an 862 in a second group
+GLII_X12 = isa("GLII006") + "".join(segment + "~\n" for segment in [
+    "GS*PS*GLII006*THOMSON*20201006*1015*123*X*004010",
+    "ST*830*0001",
+    "BFR*05**1*DL*A*20201006*20201231*20201006",
+    "SE*3*0001",
+    "ST*830*0002",
+    "BFR*05**2*DL*A*20201006*20201231*20201006",
+    "SE*3*0002",
+    "GE*2*123",
+    "GS*SS*GLII006*THOMSON*20201006*1015*124*X*004010",
+    "ST*862*0003",
+    "BSS*05*1*20201006*DL*20201006*20201031",
+    "SE*3*0003",
+    "GE*1*124",
+    "IEA*2*000000123",
+])
+
+GASPA_EDIFACT = ("UNA:+.? 'UNB+UNOA:3+US080950568SPA:ZZ+THOMSON:ZZ+201006:1015+77'"
+                 "UNH+1+DELFOR:D:96A:UN'BGM+241+123+9'UNT+3+1'"
+                 "UNH+2+DELJIT:D:96A:UN'BGM+241+124+9'UNT+3+2'"
+                 "UNZ+2+77'")
+
+
+def golden(name):
+    with open(os.path.join(GOLDEN_DIR, name), newline="", encoding="latin-1") as golden_file:
+        return golden_file.read()
+
+
+def envelope(tmp_path, text):
+    path = tmp_path / "file.edi"
+    path.write_text(text)
+    return edi.read_envelope(str(path), (), True)
+
+
+def test_build_ack_997(tmp_path):
+    text, count = edi.build_ack_x12([envelope(tmp_path, GLII_X12)], "997", 7, NOW)
+    assert count == 2
+    assert text == golden("ack_997.edi")
+
+
+def test_build_ack_999(tmp_path):
+    env = envelope(tmp_path, GLII_X12.replace("004010", "005010X222A1"))
+    text, count = edi.build_ack_x12([env], "999", 8, NOW)
+    assert count == 2
+    assert text == golden("ack_999.edi")
+
+
+def test_build_ack_contrl(tmp_path):
+    text, count = edi.build_ack_edifact([envelope(tmp_path, GASPA_EDIFACT)], 9, NOW)
+    assert count == 1
+    assert text == golden("ack_contrl.edi")
+
+
+def test_split_file_acknowledged_once(tmp_path, monkeypatch):
+    # The pieces of a split file are answered as the groups that were sent
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "1027-20201006101520-0001.edi").write_text(GLII_X12)
+    monkeypatch.setattr(edi.time, "localtime", lambda *args: NOW)
+    ack_dir = tmp_path / "ACK"
+    options = edi.Options(split=True, ack_dir=str(ack_dir))
+    assert edi.process_files(["1027-20201006101520-0001.edi"], options=options) == []
+    assert len(os.listdir(in_dir)) == 3
+    assert sorted(os.listdir(ack_dir)) == ["AUTONEUM-997-20201006101520-000000001.edi", "ack_control.json"]
+    assert (ack_dir / "AUTONEUM-997-20201006101520-000000001.edi").read_text() == golden("ack_997_split.edi")
+
+
+def test_bundle_member_acknowledged(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    with zipfile.ZipFile(staging / "day.zip", "w") as bundle:
+        bundle.writestr("1027-20201006101520-0001.edi", GLII_X12)
+    monkeypatch.setattr(edi.time, "localtime", lambda *args: NOW)
+    extracted = []
+    monkeypatch.setattr(edi, "extract_renamed",
+                        lambda new_filenames, options, metrics=None: extracted.extend(new_filenames))
+    ack_dir = tmp_path / "ACK"
+    options = edi.Options(ack_dir=str(ack_dir), extract_dir=str(tmp_path / "lines"))
+    assert edi.process_files(["day.zip"], options=options) == []
+    assert extracted == ["AUTONEUM-830-20201006101520-0001.edi"]
+    # The same groups as the split file, answered the same way
+    assert (ack_dir / "AUTONEUM-997-20201006101520-000000001.edi").read_text() == golden("ack_997_split.edi")
@@ -0,0 +1,118 @@
+import gzip
+import os
+import zipfile
+
+import pytest
+
+import edi_inbound_rename as edi
+
+from test_ship_from import AURIA_856
+
+
+def make_dirs(tmp_path, monkeypatch):
+    staging = tmp_path / "STAGING"
+    in_dir = tmp_path / "IN"
+    staging.mkdir()
+    in_dir.mkdir()
+    monkeypatch.setattr(edi, "staging_dir", str(staging))
+    monkeypatch.setattr(edi, "in_dir", str(in_dir))
+    return staging, in_dir
+
+
+def corrupt_member(path, name):
+    # Gives the member's deflate data an invalid block type, so reading it
+    # raises zlib.error
+    with zipfile.ZipFile(path) as bundle:
+        info = bundle.getinfo(name)
+    with open(path, "r+b") as data:
+        data.seek(info.header_offset + 30 + len(name.encode()))
+        data.write(b"\xff")
+
+
+def test_unpack_bundle(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    with zipfile.ZipFile(staging / "day.zip", "w", zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr("1027-20201006101520-0001.edi", AURIA_856)
+        bundle.writestr("notes.txt", "not EDI")
+    assert edi.unpack_bundles(["day.zip", "other.edi"]) == (
+        ["other.edi"], [("AURIAOF-HOW-856-20201006101520-0001.edi", None)])
+    assert sorted(os.listdir(in_dir)) == ["AURIAOF-HOW-856-20201006101520-0001.edi", "notes.txt"]
+    assert os.listdir(staging) == []
+
+
+def test_unpack_bundle_corrupt_member(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    with zipfile.ZipFile(staging / "day.zip", "w", zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr("1027-20201006101520-0001.edi", AURIA_856)
+        bundle.writestr("1027-20201006101520-0002.edi", AURIA_856 * 20)
+    corrupt_member(staging / "day.zip", "1027-20201006101520-0002.edi")
+    # The bundle is left as it is, and no member is written
+    assert edi.unpack_bundles(["day.zip"]) == (["day.zip"], [])
+    assert os.listdir(in_dir) == []
+    assert os.listdir(staging) == ["day.zip"]
+
+
+def test_unpack_bundle_corrupt_gzip(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    data = bytearray(gzip.compress((AURIA_856 * 20).encode()))
+    data[10] = 0xff  # First byte after the gzip header
+    (staging / "1027-20201006101520-0001.edi.gz").write_bytes(bytes(data))
+    assert edi.unpack_bundles(["1027-20201006101520-0001.edi.gz"]) == (
+        ["1027-20201006101520-0001.edi.gz"], [])
+    assert os.listdir(in_dir) == []
+
+
+def make_bundle(staging, members):
+    with zipfile.ZipFile(staging / "day.zip", "w") as bundle:
+        for name, text in members:
+            bundle.writestr(name, text)
+
+
+def test_bundle_members_split(tmp_path, monkeypatch):
+    from test_acks import GLII_X12
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    make_bundle(staging, [("1027-20201006101520-0001.edi", GLII_X12)])
+    assert edi.process_files(["day.zip"], options=edi.Options(split=True)) == []
+    assert sorted(os.listdir(in_dir)) == [
+        "AUTONEUM-830-20201006101520-0001_001.edi", "AUTONEUM-830-20201006101520-0001_002.edi",
+        "AUTONEUM-862-20201006101520-0001_003.edi"]
+    assert os.listdir(staging) == []
+
+
+def test_bundle_members_journalled(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    make_bundle(staging, [("1027-20201006101520-0001.edi", AURIA_856)])
+    planned = []
+    apply_plan = edi.apply_plan
+    monkeypatch.setattr(edi, "apply_plan",
+                        lambda plan, *args: planned.extend(plan) or apply_plan(plan, *args))
+    options = edi.Options(journal=str(tmp_path / "journal.log"))
+    assert edi.process_files(["day.zip"], options=options) == []
+    assert planned == [(str(staging / "1027-20201006101520-0001.edi"),
+                        str(in_dir / "AURIAOF-HOW-856-20201006101520-0001.edi"))]
+    assert os.listdir(staging) == []
+
+
+def test_bundle_dry_run(tmp_path, monkeypatch, capsys):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    make_bundle(staging, [("1027-20201006101520-0001.edi", AURIA_856)])
+    edi.process_files(["day.zip"], options=edi.Options(dry_run=True))
+    out = capsys.readouterr().out
+    assert "day.zip:1027-20201006101520-0001.edi  >  " + str(in_dir / "AURIAOF-HOW-856") in out
+    assert "IN/day.zip" not in out.replace(os.sep, "/")
+    assert os.listdir(staging) == ["day.zip"]
+    assert os.listdir(in_dir) == []
+
+
+def test_stage_bundle_again_after_stop(tmp_path, monkeypatch):
+    # A member already unpacked by a run that stopped before removing the
+    # bundle is taken as it is
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    make_bundle(staging, [("1027-20201006101520-0001.edi", AURIA_856), ("notes.txt", "x")])
+    (staging / "notes.txt").write_text("x")
+    assert edi.stage_bundle("day.zip") == ["1027-20201006101520-0001.edi", "notes.txt"]
+    assert sorted(os.listdir(staging)) == ["1027-20201006101520-0001.edi", "notes.txt"]
+    make_bundle(staging, [("notes.txt", "y")])
+    with pytest.raises(FileExistsError):
+        edi.stage_bundle("day.zip")
+    assert (staging / "notes.txt").read_text() == "x"
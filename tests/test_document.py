@@ -0,0 +1,21 @@
+import edi_document
+
+DELFOR = ("UNA:+.? 'UNB+%s:3+US080950568SPA:ZZ+THOMSON:ZZ+201006:1015+77'"
+          "UNH+1+DELFOR:D:96A:UN'BGM+241+123+9'NAD+SF+4410::92++GRÜNER WERK'"
+          "UNT+4+1'UNZ+1+77'")
+
+
+def test_unoc_read_as_latin_1(tmp_path):
+    path = tmp_path / "delfor.edi"
+    path.write_bytes((DELFOR % "UNOC").encode("latin-1"))
+    ts, = edi_document.iter_transaction_sets(str(path))
+    assert ts.doc_type == "DELFOR"
+    assert ts.find("NAD").value(4, 0) == "GRÜNER WERK"
+
+
+def test_unow_read_as_utf_8(tmp_path):
+    path = tmp_path / "delfor.edi"
+    path.write_bytes((DELFOR % "UNOW").encode("utf-8"))
+    interchange, = edi_document.read_document(str(path))
+    ts, = interchange.transaction_sets()
+    assert ts.find("NAD").value(4, 0) == "GRÜNER WERK"
@@ -0,0 +1,74 @@
+import json
+import os
+
+import pytest
+
+import edi_inbound_rename as edi
+
+from test_bundles import make_dirs
+
+NAMES = ["1027-20201006101520-0001.edi", "1027-20201006101520-0002.edi"]
+
+
+def stopped_run(tmp_path, monkeypatch):
+    # STAGING and IN as a run leaves them when it stops after the first of
+    # two journalled renames
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    plan = [(str(staging / name), str(in_dir / ("NEW-" + name))) for name in NAMES]
+    (in_dir / ("NEW-" + NAMES[0])).write_text("first")
+    (staging / NAMES[1]).write_text("second")
+    journal = tmp_path / "journal.log"
+    journal.write_text(json.dumps({"plan": plan}) + "\n" + json.dumps({"done": 0}) + "\n")
+    return staging, in_dir, journal
+
+
+def test_replay(tmp_path, monkeypatch):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    edi.recover_journal(str(journal))
+    assert os.listdir(staging) == []
+    assert sorted(os.listdir(in_dir)) == ["NEW-" + name for name in NAMES]
+    assert not journal.exists()
+
+
+def test_rollback(tmp_path, monkeypatch):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    edi.recover_journal(str(journal), "rollback")
+    assert sorted(os.listdir(staging)) == NAMES
+    assert os.listdir(in_dir) == []
+    assert not journal.exists()
+
+
+@pytest.mark.parametrize("mode", ["replay", "rollback"])
+def test_recover_twice(tmp_path, monkeypatch, mode):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    text = journal.read_text()
+    edi.recover_journal(str(journal), mode)
+    journal.write_text(text)
+    edi.recover_journal(str(journal), mode)
+    assert len(os.listdir(staging)) + len(os.listdir(in_dir)) == 2
+
+
+def test_committed_journal_not_replayed(tmp_path, monkeypatch):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    journal.write_text(journal.read_text() + json.dumps({"failed": 1}) + "\n"
+                       + json.dumps({"commit": True}) + "\n")
+    edi.recover_journal(str(journal))
+    assert os.listdir(staging) == [NAMES[1]]
+    assert not journal.exists()
+
+
+def test_cut_short_record(tmp_path, monkeypatch):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    journal.write_text(journal.read_text() + '{"do')
+    edi.recover_journal(str(journal))
+    assert os.listdir(staging) == []
+
+
+def test_dry_run_recovery_moves_nothing(tmp_path, monkeypatch, capsys):
+    staging, in_dir, journal = stopped_run(tmp_path, monkeypatch)
+    options = edi.Options(journal=str(journal), dry_run=True, chunk_size=0)
+    edi.process_staging_dir(options)
+    assert os.listdir(staging) == [NAMES[1]]
+    assert os.listdir(in_dir) == ["NEW-" + NAMES[0]]
+    assert journal.exists()
+    assert str(staging / NAMES[1]) + "  >  " + str(in_dir / ("NEW-" + NAMES[1])) in capsys.readouterr().out
@@ -0,0 +1,27 @@
+import os
+
+import edi_inbound_rename as edi
+
+from test_bundles import make_dirs
+
+NEW_FILENAME = "AURIAOF-HOW-856-20201006101520-0001.edi"
+
+
+def test_migrate_round_trip(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (in_dir / NEW_FILENAME).write_text("x")
+    (in_dir / "notes.txt").write_text("x")
+    assert edi.migrate_in_dir("sharded") == 1
+    assert (in_dir / "AURIAOF" / "856" / "20201006" / NEW_FILENAME).exists()
+    assert edi.migrate_in_dir("flat") == 1
+    assert sorted(os.listdir(in_dir)) == ["AURIAOF", NEW_FILENAME, "notes.txt"]
+
+
+def test_migrate_flat_leaves_other_folders(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    for folder in (in_dir / "ARCHIVE" / "2020", in_dir / "AURIAOF" / "856" / "20201007",
+                   in_dir / "AURIAOF" / "856" / "20201006" / "OLD"):
+        folder.mkdir(parents=True)
+        (folder / NEW_FILENAME).write_text("x")
+    assert edi.migrate_in_dir("flat") == 0
+    assert not (in_dir / NEW_FILENAME).exists()
@@ -0,0 +1,78 @@
+import os
+import zipfile
+
+import edi_inbound_rename as edi
+
+from test_bundles import make_dirs
+from test_ship_from import AURIA_856
+
+FILENAME = "1027-20201006101520-0001.edi"
+NEW_FILENAME = "AURIAOF-HOW-856-20201006101520-0001.edi"
+
+
+def test_journal_fallback_not_extracted(tmp_path, monkeypatch):
+    # A file whose new name is taken is moved under its own name, so the
+    # file already at the new name must not be read as if it were routed
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / FILENAME).write_text(AURIA_856)
+    (in_dir / NEW_FILENAME).write_text("unrelated")
+    extracted = []
+    monkeypatch.setattr(edi, "extract_renamed",
+                        lambda new_filenames, options, metrics=None: extracted.extend(new_filenames))
+    options = edi.Options(journal=str(tmp_path / "journal.log"), extract_dir=str(tmp_path / "lines"))
+    assert edi.process_files([FILENAME], options=options) == []
+    assert (in_dir / FILENAME).exists()
+    assert extracted == []
+
+
+def test_failed_move_not_indexed(tmp_path, monkeypatch):
+    # A file left in STAGING by a failed move isn't a duplicate of itself
+    # on the next run
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / FILENAME).write_text(AURIA_856)
+    monkeypatch.setattr(edi, "move_files", lambda pairs, workers=0: [OSError("share offline")])
+    dedupe = edi.DuplicateIndex(str(tmp_path / "dedupe.db"))
+    options = edi.Options(journal=str(tmp_path / "journal.log"),
+                          quarantine_dir=str(tmp_path / "QUARANTINE"))
+    assert edi.process_files([FILENAME], options=options, dedupe=dedupe) == [FILENAME]
+    assert dedupe.count == 0
+    dedupe.close()
+
+
+def test_bundle_member_duplicate_quarantined(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    with zipfile.ZipFile(staging / "day.zip", "w") as bundle:
+        bundle.writestr(FILENAME, AURIA_856)
+        bundle.writestr("1027-20201006101520-0002.edi", AURIA_856)
+    (staging / "1027-20201006101520-0003.edi").write_text(AURIA_856)
+    dedupe = edi.DuplicateIndex(str(tmp_path / "dedupe.db"))
+    options = edi.Options(quarantine_dir=str(tmp_path / "QUARANTINE"))
+    edi.process_files(["day.zip", "1027-20201006101520-0003.edi"], options=options,
+                      dedupe=dedupe)
+    # The first member is routed, the repeats of its interchange aren't
+    assert os.listdir(in_dir) == [NEW_FILENAME]
+    assert sorted(os.listdir(tmp_path / "QUARANTINE")) == [
+        "1027-20201006101520-0002.edi", "1027-20201006101520-0003.edi"]
+    assert dedupe.count == 1
+    dedupe.close()
+
+
+def test_remaining_file_not_overwritten(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "notes.txt").write_text("new")
+    (in_dir / "notes.txt").write_text("old")
+    assert edi.process_files(["notes.txt"], options=edi.Options()) == ["notes.txt"]
+    assert (in_dir / "notes.txt").read_text() == "old"
+    assert (staging / "notes.txt").read_text() == "new"
+
+
+def test_failed_remaining_move_left(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "notes.txt").write_text("new")
+
+    def move_file(old_filename, new_filename):
+        raise PermissionError(13, "Access is denied", old_filename)
+
+    monkeypatch.setattr(edi, "move_file", move_file)
+    assert edi.process_files(["notes.txt"], options=edi.Options()) == ["notes.txt"]
+    assert os.listdir(in_dir) == []
@@ -0,0 +1,52 @@
+import pytest
+
+import edi_inbound_rename as edi
+
+
+def test_answer_needs_an_object():
+    service = edi.ClassifyService()
+    assert service.answer(["x"]) == {"error": "request must be a JSON object"}
+    assert service.answer("x") == {"error": "request must be a JSON object"}
+    assert service.answer({}) == {"error": "request needs a path"}
+
+
+@pytest.mark.parametrize("address", ["0.0.0.0:8750", "192.168.1.20:8750", "edi-host:8750", "[::]:8750"])
+def test_make_server_refuses_other_hosts(address):
+    with pytest.raises(ValueError):
+        edi.make_server(address)
+
+
+@pytest.mark.parametrize("address", ["127.0.0.1:0", "localhost:0"])
+def test_make_server_loopback(address):
+    server = edi.make_server(address)
+    server.server_close()
+
+
+def test_make_server_keeps_other_files(tmp_path):
+    path = tmp_path / "partners.json"
+    path.write_text("{}")
+    with pytest.raises(FileExistsError):
+        edi.make_server(str(path))
+    assert path.read_text() == "{}"
+
+
+def test_make_server_replaces_stale_socket(tmp_path):
+    path = str(tmp_path / "edi.sock")
+    edi.make_server(path).server_close()
+    server = edi.make_server(path)
+    server.server_close()
+
+
+def test_route_only_from_staging(tmp_path, monkeypatch):
+    from test_bundles import make_dirs
+    from test_ship_from import AURIA_856
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    outside = tmp_path / "1027-20201006101520-0001.edi"
+    outside.write_text(AURIA_856)
+    service = edi.ClassifyService()
+    assert "error" in service.answer({"op": "route", "path": str(outside)})
+    assert outside.exists()
+    # classify still reads any path
+    assert service.answer({"op": "classify", "path": str(outside)})["tag"] == "AURIAOF"
+    (staging / outside.name).write_text(AURIA_856)
+    assert service.answer({"op": "route", "path": str(staging / outside.name)})["routed"]
@@ -0,0 +1,72 @@
+import io
+import mmap
+
+import edi_inbound_rename as edi
+
+
+def isa(sender):
+    # A fixed width ISA, terminator included
+    header = ("ISA*00*          *00*          *ZZ*%-15s*ZZ*THOMSON        *201006*1015*U*00401"
+              "*000000123*0*P*>~" % sender)
+    assert len(header) == edi.ISA_SIZE
+    return header
+
+
+# An 856 with the N1*SF inside the HL loop, well past the ST
+AURIA_856 = isa("ONCBUSUPPU") + "".join(segment + "~\n" for segment in [
+    "GS*SH*ONCBUSUPPU*THOMSON*20201006*1015*123*X*004010",
+    "ST*856*0001",
+    "BSN*00*SHP1*20201006*1015",
+    "HL*1**S",
+    "TD1*CTN*4",
+    "TD5*B*2*RDWY",
+    "REF*BM*BOL1",
+    "DTM*011*20201006",
+    "N1*ST*THOMSON PLASTICS*92*TPL",
+    "N1*SF*AURIA OLD FORT*92*02054850",
+    "HL*2*1*O",
+    "PRF*PO1",
+    "HL*3*2*I",
+    "LIN**BP*ABC",
+    "SN1**10*EA",
+    "CTT*3",
+    "SE*16*0001",
+    "GE*1*123",
+    "IEA*1*000000123",
+])
+
+
+def find_in(tmp_path, data, tag, term):
+    path = tmp_path / "file.edi"
+    path.write_bytes(data)
+    with open(path, "rb") as edifile, mmap.mmap(edifile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return edi.find_segment(mm, tag, term)[0]
+
+
+def test_find_segment_after_line_break(tmp_path):
+    data = b"ST*850*0001~\r\nN1*SF*HUSQVARNA*92*4410~\r\n"
+    assert find_in(tmp_path, data, b"N1*SF*", b"~") == b"N1*SF*HUSQVARNA*92*4410"
+
+
+def test_find_segment_cr_terminator_with_lf(tmp_path):
+    # The CR is the terminator, so only the LF after it is skipped
+    data = b"ST*850*0001\r\nN1*SF*HUSQVARNA*92*4410\r\n"
+    assert find_in(tmp_path, data, b"N1*SF*", b"\r") == b"N1*SF*HUSQVARNA*92*4410"
+
+
+def test_find_segment_ignores_tag_inside_element(tmp_path):
+    data = b"ST*850*0001~REF*ZZ*N1*SF*X~"
+    assert find_in(tmp_path, data, b"N1*SF*", b"~") is None
+
+
+def test_ship_from_inside_856_hl_loop(tmp_path):
+    path = tmp_path / "1027-20201006101520-0001.edi"
+    path.write_text(AURIA_856)
+    result = edi.classify_file_detail(str(path))
+    assert result.new_filename == "AURIAOF-HOW-856-20201006101520-0001.edi"
+
+
+def test_ship_from_inside_856_hl_loop_in_bundle():
+    data = AURIA_856.encode()
+    result = edi.classify_file_detail("1027-20201006101520-0001.edi", lambda: io.BytesIO(data))
+    assert result.new_filename == "AURIAOF-HOW-856-20201006101520-0001.edi"
@@ -0,0 +1,62 @@
+import os
+
+import edi_inbound_rename as edi
+
+from test_acks import GASPA_EDIFACT, GLII_X12, golden
+from test_bundles import make_dirs
+
+
+def test_split_x12(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "1027-20201006101520-0001.edi").write_text(GLII_X12)
+    pieces = edi.split_file("1027-20201006101520-0001.edi")
+    assert pieces == ["1027-20201006101520-0001_%03d.edi" % idx for idx in (1, 2, 3)]
+    assert sorted(os.listdir(staging)) == pieces
+    for idx, piece in enumerate(pieces, 1):
+        assert (staging / piece).read_bytes().decode("latin-1") == golden("split_x12_%d.edi" % idx)
+
+
+def test_split_x12_cr_terminator(tmp_path, monkeypatch):
+    # A CR terminator, with and without an LF after it, is kept as it is
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    for name, line_break in (("1027-20201006101520-0004.edi", "\r"),
+                             ("1027-20201006101520-0005.edi", "\r\n")):
+        (staging / name).write_bytes(GLII_X12.replace("~\n", line_break).replace("~", "\r").encode())
+        pieces = edi.split_file(name)
+        assert len(pieces) == 3
+        for idx, piece in enumerate(pieces, 1):
+            expected = golden("split_x12_%d.edi" % idx).replace("~", "\r")
+            assert (staging / piece).read_bytes().decode("latin-1") == expected
+
+
+def test_split_x12_crlf(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "1027-20201006101520-0006.edi").write_bytes(GLII_X12.replace("\n", "\r\n").encode())
+    pieces = edi.split_file("1027-20201006101520-0006.edi")
+    assert len(pieces) == 3
+    for idx, piece in enumerate(pieces, 1):
+        assert (staging / piece).read_bytes().decode("latin-1") == golden("split_x12_%d.edi" % idx)
+
+
+def test_split_keeps_file_when_pieces_are_missing(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "1027-20201006101520-0007.edi").write_text(GLII_X12)
+    monkeypatch.setattr(edi, "split_x12", lambda edifile, env, open_piece: open_piece().close())
+    assert edi.split_staging_files(["1027-20201006101520-0007.edi"]) == ["1027-20201006101520-0007.edi"]
+    assert os.listdir(staging) == ["1027-20201006101520-0007.edi"]
+
+
+def test_split_edifact(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "1027-20201006101520-0002.edi").write_text(GASPA_EDIFACT)
+    pieces = edi.split_file("1027-20201006101520-0002.edi")
+    assert pieces == ["1027-20201006101520-0002_%03d.edi" % idx for idx in (1, 2)]
+    for idx, piece in enumerate(pieces, 1):
+        assert (staging / piece).read_bytes().decode("latin-1") == golden("split_edifact_%d.edi" % idx)
+
+
+def test_single_set_not_split(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    text = GLII_X12.split("ST*830*0002")[0] + "GE*1*123~\nIEA*1*000000123~\n"
+    (staging / "1027-20201006101520-0003.edi").write_text(text)
+    assert edi.split_file("1027-20201006101520-0003.edi") == ["1027-20201006101520-0003.edi"]
@@ -0,0 +1,54 @@
+import os
+
+import edi_inbound_rename as edi
+
+from test_bundles import make_dirs
+
+
+def test_scan_skips_file_gone_since_listing(tmp_path, monkeypatch):
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "gone.edi").write_text("x")
+    (staging / "kept.edi").write_text("x")
+    scandir = os.scandir
+
+    class Listing:
+        # Lists STAGING, then loses gone.edi before it is stat'ed
+        def __init__(self, path):
+            with scandir(path) as entries:
+                self.entries = list(entries)
+            os.remove(staging / "gone.edi")
+
+        def __enter__(self):
+            return iter(self.entries)
+
+        def __exit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(edi.os, "scandir", Listing)
+    pending = {}
+    assert edi.scan_staging_dir(pending, set()) == []
+    assert list(pending) == ["kept.edi"]
+
+
+def test_watch_scans_while_events_arrive(tmp_path, monkeypatch):
+    # A file there at startup is routed even though the watcher never
+    # comes back empty
+    staging, in_dir = make_dirs(tmp_path, monkeypatch)
+    (staging / "notes.txt").write_text("x")
+
+    class Watcher:
+        waits = 0
+
+        def wait(self, timeout):
+            self.waits += 1
+            if self.waits > 3:
+                raise KeyboardInterrupt
+            return ["arriving.edi"]
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(edi, "open_watcher", lambda path: Watcher())
+    monkeypatch.setattr(edi, "reload_partners", lambda *args: False)
+    edi.watch_staging_dir(edi.Options(interval=0))
+    assert os.listdir(in_dir) == ["notes.txt"]